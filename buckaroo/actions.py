@@ -1,18 +1,22 @@
 from decimal import Decimal
 from django.conf import settings
+from django.db import transaction as db_transaction
+from django_fsm import TransitionNotAllowed
 from rest_framework import status
 
-from actstream import action
-
+from .activity import send_action
 from .exceptions import BuckarooException
+from .log import LogEvent, Payload
+from .methods import get_payment_method
+from .metrics import transitions_not_allowed
+from .tracing import span
 from .models import (BUCKAROO_790_PENDING_INPUT, BUCKAROO_791_PENDING_PROCESSING,
                      BUCKAROO_792_AWAITING_CONSUMER, BUCKAROO_190_SUCCESS,
                      BUCKAROO_793_ON_HOLD)
 
-from .utils import (construct_url, buckaroo_api_call, get_base_transaction_json,
-                    add_pay_json, add_ideal_json, get_payment_key, get_transaction_key,
-                    get_redirect_url, get_buckaroo_status_code, add_refund_json,
-                    add_creditcard_json, verify_transaction_fields)
+from .utils import (construct_url, get_base_url, buckaroo_api_call,
+                    get_base_transaction_json, add_pay_json, add_refund_json,
+                    verify_transaction_fields, BUCKAROO_REFUND_URL)
 
 
 import logging
@@ -24,13 +28,6 @@ BUCKAROO_PENDING_STATUSES = [BUCKAROO_790_PENDING_INPUT,
                              BUCKAROO_792_AWAITING_CONSUMER]
 
 
-BUCKAROO_BASE_TEST_URL = 'https://testcheckout.buckaroo.nl/'
-BUCKAROO_BASE_PRODUCTION_URL = 'https://checkout.buckaroo.nl/'
-
-BUCKAROO_CHECKOUT_URL = "json/Transaction/"
-BUCKAROO_REFUND_URL = 'json/Transaction/RefundInfo/'
-
-
 class BuckarooSettingsMixin:
 
     def __init__(self):
@@ -61,62 +58,86 @@ class Pay(BuckarooSettingsMixin):
 
     def pay(self):
 
-        verify_transaction_fields(transaction=self.transaction)
+        with span('pay', self.transaction):
+            verify_transaction_fields(transaction=self.transaction)
 
-        data = self._prepare_pay_json()
+            data = self._prepare_pay_json()
 
-        url = construct_url()
+            url = construct_url()
 
-        res = buckaroo_api_call(self.transaction, url, "POST", data)
+            res = buckaroo_api_call(self.transaction, url, "POST", data)
 
-        self._handle_transaction_response(response=res)
+            self._handle_transaction_response(response=res)
 
     def _prepare_pay_json(self):
-        base = get_base_transaction_json(self.transaction)
-        body = add_pay_json(base, self.transaction)
+        with span('build_payload', self.transaction):
+            base = get_base_transaction_json(self.transaction)
+            body = add_pay_json(base, self.transaction)
 
-        if self.transaction.payment_method == 'ideal':
-            return add_ideal_json(body, self.transaction, 'pay')
-        elif self.transaction.payment_method == 'creditcard':
-            return add_creditcard_json(body, self.transaction, 'pay')
-        else:
-            return {}
+            method = get_payment_method(self.transaction.payment_method)
+            if method is None:
+                return {}
+            return method.add_service_json(body, self.transaction, 'pay')
 
     def _handle_transaction_response(self, response=None):
-        """Handle the Buckaroo response to update the transaction."""
+        """
+        Handle the Buckaroo response to update the transaction.
 
-        self.transaction.payment_key = get_payment_key(response.json())
-        self.transaction.save()
+        The transaction is written once. When the response is rejected the
+        keys Buckaroo handed out are still stored before raising.
+        """
 
-        self.transaction.transaction_key = get_transaction_key(response.json())
-        self.transaction.save()
-
-        if response.status_code != status.HTTP_200_OK:
-            raise BuckarooException({"message": 'Invalid API status code',
-                                     "description": "The request to the Buckaroo API was "
-                                     "unsuccessful",
-                                     "status": response.status_code})
+        update_fields = ['modified']
 
-        b_status_code = get_buckaroo_status_code(response.json())
-
-        if b_status_code not in BUCKAROO_PENDING_STATUSES:
-            raise BuckarooException({"message": "Invalid Buckaroo transaction status",
-                                     "Buckaroo Status": b_status_code})
-
-        self.transaction.pending()
-        self.transaction.redirect_url = get_redirect_url(response.json())
-        self.transaction.save()
+        try:
+            if response.status_code != status.HTTP_200_OK:
+                # Error responses often carry no keys, keep the ones that are there.
+                data = response.data if isinstance(response.data, dict) else {}
+                for field, key in (('payment_key', 'PaymentKey'), ('transaction_key', 'Key')):
+                    if data.get(key):
+                        setattr(self.transaction, field, data[key])
+                        update_fields.append(field)
+
+                raise BuckarooException({"message": 'Invalid API status code',
+                                         "description": "The request to the Buckaroo API was "
+                                         "unsuccessful",
+                                         "status": response.status_code})
+
+            self.transaction.payment_key = response.payment_key
+            update_fields.append('payment_key')
+            self.transaction.transaction_key = response.transaction_key
+            update_fields.append('transaction_key')
+
+            b_status_code = response.status
+
+            if b_status_code not in BUCKAROO_PENDING_STATUSES:
+                raise BuckarooException({"message": "Invalid Buckaroo transaction status",
+                                         "Buckaroo Status": b_status_code})
+
+            redirect_url = response.redirect_url
+
+            with db_transaction.atomic(), span('fsm_transition', self.transaction,
+                                                 target=self.transaction.STATUS_PENDING):
+                self.transaction.pending()
+                self.transaction.redirect_url = redirect_url
+                self.transaction.save(update_fields=update_fields + ['status', 'redirect_url'])
+        except (BuckarooException, TransitionNotAllowed) as e:
+            if isinstance(e, TransitionNotAllowed):
+                transitions_not_allowed.inc(target=self.transaction.STATUS_PENDING)
+            self.transaction.save(update_fields=update_fields)
+            raise
 
 
 class Refund(BuckarooSettingsMixin):
     """Refunding happens on a per ticket basis."""
 
-    def __init__(self, transaction=None, amount=0, testing=True):
+    def __init__(self, transaction=None, amount=0, testing=True, rate_limiter=None):
 
         super().__init__()
 
         self.transaction = transaction
         self.testing = testing
+        self.rate_limiter = rate_limiter
         self.fee = Decimal(settings.BUCKAROO_REFUND_FEE)
         self.amount = amount
         self.refund_amount = self.amount - self.fee
@@ -125,17 +146,18 @@ class Refund(BuckarooSettingsMixin):
         if self.refund_amount < 0:
             self.refund_amount = self.amount
 
-        if self.testing:
-            self.refund_info_url = ''.join([BUCKAROO_BASE_TEST_URL,
-                                            BUCKAROO_REFUND_URL])
-        else:
-            self.refund_info_url = ''.join([BUCKAROO_BASE_PRODUCTION_URL,
-                                            BUCKAROO_REFUND_URL])
+        self.refund_info_url = ''.join([get_base_url(self.testing),
+                                        BUCKAROO_REFUND_URL])
 
         self.is_refundable = False
         self.max_refund_amount = -1
         self.partial_allowed = False
         self.refunded_amount = 0
+        self.b_status_code = None
+
+    def _throttle(self):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
 
     def _update_refund_info(self, response={}):
         try:
@@ -166,43 +188,55 @@ class Refund(BuckarooSettingsMixin):
             raise BuckarooException(
                 {"message": "'RefundedAmonut' not in API response"})
 
+    def _get_refund_info_url(self):
+        return ''.join([self.refund_info_url, str(
+            self.transaction.transaction_key)])
+
     def get_refund_info(self):
         """Get the refund options for a transaction."""
-        url = ''.join([self.refund_info_url, str(
-            self.transaction.transaction_key)])
+        url = self._get_refund_info_url()
 
+        self._throttle()
         res = buckaroo_api_call(self.transaction, url, 'GET')
 
-        self._update_refund_info(response=res.json())
+        self._update_refund_info(response=res.data)
 
     def _prepare_refund_json(self):
 
-        base = get_base_transaction_json(self.transaction)
-        body = add_refund_json(base, self.transaction, self.refund_amount)
+        with span('build_payload', self.transaction):
+            base = get_base_transaction_json(self.transaction)
+            body = add_refund_json(base, self.transaction, self.refund_amount)
 
-        if self.transaction.payment_method == 'ideal':
-            return add_ideal_json(body, self.transaction, 'refund')
-        elif self.transaction.payment_method == 'creditcard':
-            return add_creditcard_json(body, self.transaction, 'refund')
-        return {}
+            method = get_payment_method(self.transaction.payment_method)
+            if method is None:
+                return {}
+            method.validate(self.transaction)
+            return method.add_service_json(body, self.transaction, 'refund')
 
     def refund(self):
         if settings.BUCKAROO_DISABLE_REFUND:
             return
 
-        self.get_refund_info()
+        with span('refund', self.transaction):
+            self.get_refund_info()
+
+            self._check_refund_allowed()
 
-        if not self.partial_allowed or not (self.amount - self.fee) <= self.max_refund_amount:
-            logger.error("Unable to refund. Ticket price too high to refund")
-            raise BuckarooException({"message": 'Ticket price too high'})
+            data = self._prepare_refund_json()
 
-        data = self._prepare_refund_json()
+            url = construct_url()
 
-        url = construct_url()
+            self._throttle()
+            res = buckaroo_api_call(self.transaction, url, "POST", data)
 
-        res = buckaroo_api_call(self.transaction, url, "POST", data)
+            self._handle_transaction_response(response=res)
 
-        self._handle_transaction_response(response=res)
+    def _check_refund_allowed(self):
+        method = get_payment_method(self.transaction.payment_method)
+        if method is None:
+            raise BuckarooException({"message": "Unknown payment method",
+                                     "field": "payment_method"})
+        method.check_refund(self)
 
     def _handle_transaction_response(self, response=None):
         """Handle the Buckaroo response to update the transaction."""
@@ -212,23 +246,24 @@ class Refund(BuckarooSettingsMixin):
                                      "unsuccessful",
                                      "status": response.status_code})
 
-        b_status_code = get_buckaroo_status_code(response.json())
+        b_status_code = response.status
+        self.b_status_code = b_status_code
 
         if b_status_code == BUCKAROO_190_SUCCESS:
             self.transaction.refunded = True
             self.transaction.save()
-            action.send(self.transaction, verb="was refunded (190, immediate)")
-            logger.info("Transaction {0} successfully refunded"
-                        .format(self.transaction.transaction_key))
+            send_action(self.transaction, verb="was refunded (190, immediate)")
+            logger.info(LogEvent("Transaction successfully refunded",
+                                 transaction_key=self.transaction.transaction_key))
         elif b_status_code == BUCKAROO_793_ON_HOLD:
             self.transaction.refunded = True
             self.transaction.save()
-            action.send(self.transaction, verb="was refunded (793, on hold)")
-            logger.info("Transaction {0} successfully refunded (but ONHOLD)"
-                        .format(self.transaction.transaction_key))
+            send_action(self.transaction, verb="was refunded (793, on hold)")
+            logger.info(LogEvent("Transaction successfully refunded (but ONHOLD)",
+                                 transaction_key=self.transaction.transaction_key))
 
         else:
-            logger.error("Something went wrong with the Refund transaction")
-            logger.error("{0}".format(response.json()))
+            logger.error(LogEvent("Something went wrong with the Refund transaction",
+                                  data=Payload(response.data)))
             raise BuckarooException({"message": "Invalid Buckaroo transaction status",
                                      "Buckaroo Status": b_status_code})
@@ -0,0 +1,133 @@
+"""
+Activity stream writes for transactions.
+
+By default ``send_action`` is ``actstream.action.send``. With
+``BUCKAROO_ACTIVITY_OUTBOX`` enabled, actions sent inside an activity batch
+are kept in a per-thread outbox instead. When the batch closes the outbox
+is handed to a huey task that writes it with a single ``bulk_create``.
+Actions are only added to the outbox once the surrounding database
+transaction commits, so rolled back changes leave no activity behind.
+
+Requests are batches (the request signals open and close them), and so
+are pushes, bulk refunds and reconciliation, through ``activity_batch``.
+Anywhere else, such as the async actions, the shell or management
+commands, actions are written directly, so nothing is left behind.
+"""
+
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from actstream import action
+
+from .tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+_outbox = threading.local()
+
+
+def outbox_enabled():
+    return getattr(settings, 'BUCKAROO_ACTIVITY_OUTBOX', False)
+
+
+def _batch_open():
+    return getattr(_outbox, 'depth', 0) > 0
+
+
+def _get_outbox():
+    if not hasattr(_outbox, 'records'):
+        _outbox.records = []
+    return _outbox.records
+
+
+def _make_record(actor, verb, **kwargs):
+    record = dict(actor_content_type_id=ContentType.objects.get_for_model(actor).pk,
+                  actor_object_id=str(actor.pk),
+                  verb=str(verb),
+                  description=kwargs.get('description'),
+                  public=kwargs.get('public', True),
+                  timestamp=kwargs.get('timestamp') or timezone.now())
+
+    # Same optional objects as actstream's action handler.
+    for opt in ('target', 'action_object'):
+        obj = kwargs.get(opt)
+        if obj is not None:
+            record[opt + '_content_type_id'] = ContentType.objects.get_for_model(obj).pk
+            record[opt + '_object_id'] = str(obj.pk)
+
+    return record
+
+
+def _buffer(record):
+    # The batch may have closed before the transaction committed.
+    if _batch_open():
+        _get_outbox().append(record)
+    else:
+        write_activity_records([record])
+
+
+def send_action(actor, verb, **kwargs):
+    """Record an activity for ``actor``, directly or through the outbox."""
+    if not outbox_enabled() or not _batch_open():
+        with span('activity', actor, verb=str(verb)):
+            return action.send(actor, verb=verb, **kwargs)
+
+    record = _make_record(actor, verb, **kwargs)
+    db_transaction.on_commit(lambda: _buffer(record))
+
+
+def drain_activity():
+    """Return and clear the records buffered by the current thread."""
+    records = _get_outbox()
+    _outbox.records = []
+    return records
+
+
+def write_activity_records(records):
+    from actstream.models import Action
+
+    Action.objects.bulk_create([Action(**record) for record in records])
+
+
+def flush_activity(**kwargs):
+    """Queue the buffered records for writing."""
+    records = drain_activity()
+    if not records:
+        return
+
+    from .tasks import write_activity
+
+    try:
+        write_activity(records)
+    except Exception:
+        logger.exception("Could not queue {0} activity records".format(len(records)))
+
+
+def open_activity_batch(**kwargs):
+    """Start buffering actions in this thread. Usable as a signal receiver."""
+    _outbox.depth = getattr(_outbox, 'depth', 0) + 1
+
+
+def close_activity_batch(**kwargs):
+    """End the innermost batch, the outermost one flushes the outbox."""
+    _outbox.depth = max(getattr(_outbox, 'depth', 0) - 1, 0)
+    if not _outbox.depth:
+        flush_activity()
+
+
+@contextmanager
+def activity_batch():
+    """Buffer the actions sent inside the block and flush them at the end."""
+    open_activity_batch()
+    try:
+        yield
+    finally:
+        close_activity_batch()
@@ -0,0 +1,252 @@
+"""
+asyncio client for the Buckaroo API, mirroring ``utils.buckaroo_api_call``,
+and the ``AsyncPay``/``AsyncRefund`` actions built on it.
+
+Needs the ``async`` extra (aiohttp 3.3 or later, so Python 3.5.3 or
+later). Nothing in the synchronous code paths imports this module.
+"""
+
+import asyncio
+import functools
+import logging
+import weakref
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .actions import Pay, Refund
+from .auth import BuckarooAuth, encode_json_body
+from .exceptions import BuckarooException
+from .log import LogEvent, Payload
+from .client import DEFAULT_POOL_MAXSIZE
+from .metrics import record_status, track_api_call
+from .tracing import span
+from .resilience import RetryPolicy, get_circuit_breaker, get_timeout
+from .utils import BuckarooResponse, construct_url, verify_transaction_fields
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBuckarooClient:
+    """
+    Keeps one ``aiohttp.ClientSession`` with a bounded connection pool.
+
+    Uses the same timeouts, retry policy and circuit breaker as the
+    blocking ``BuckarooClient``.
+    """
+
+    def __init__(self, limit=DEFAULT_POOL_MAXSIZE, limit_per_host=DEFAULT_POOL_MAXSIZE,
+                 retry_policy=None):
+        if aiohttp is None:
+            raise BuckarooException("aiohttp is required for the async Buckaroo client")
+
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.retry_policy = retry_policy or RetryPolicy(retries=0)
+        self.session = None
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, method, url, headers=None, data=None, auth=None):
+        """
+        ``data`` is the encoded request body. ``auth`` is a ``BuckarooAuth``,
+        every attempt is signed anew.
+        """
+        breaker = get_circuit_breaker()
+        breaker.before_call()
+
+        with track_api_call(url, method):
+            try:
+                res = await self._send(method, url, headers=headers, data=data, auth=auth)
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled or interrupted, which says nothing about Buckaroo.
+                breaker.release()
+                raise
+
+            if res.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        return res
+
+    async def _send(self, method, url, headers=None, data=None, auth=None):
+        connect_timeout, read_timeout = get_timeout()
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        attempt = 0
+
+        while True:
+            attempt_headers = dict(headers or {})
+            if auth is not None:
+                attempt_headers['Authorization'] = auth.get_header(url, method)
+
+            try:
+                res = await self._request_once(method, url, attempt_headers, data, timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                not_sent = isinstance(e, aiohttp.ClientConnectorError)
+                if not self.retry_policy.should_retry(attempt, method, exc=e,
+                                                      not_sent=not_sent):
+                    logger.error(LogEvent("Buckaroo request failed", method=method, url=url,
+                                          error=repr(e)))
+                    raise BuckarooException({"message": "Buckaroo API request failed",
+                                             "description": repr(e)}) from e
+            else:
+                if not self.retry_policy.should_retry(attempt, method,
+                                                      status_code=res.status_code):
+                    return res
+
+            delay = self.retry_policy.delay(attempt)
+            attempt += 1
+            logger.warning(LogEvent("Retrying Buckaroo request", method=method, url=url,
+                                    delay=round(delay, 2), attempt=attempt))
+            await asyncio.sleep(delay)
+
+    async def _request_once(self, method, url, headers, data, timeout):
+        session = self._get_session()
+        async with session.request(method, url, headers=headers, data=data,
+                                   timeout=timeout) as res:
+            try:
+                data = await res.json(content_type=None)
+            except ValueError:
+                logger.error("Buckaroo response is not valid JSON")
+                data = {}
+            return BuckarooResponse(status_code=res.status, data=data)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+
+
+def _close_connections(func, *args):
+    # Executor threads are not request threads, nothing else closes their
+    # database connections or applies CONN_MAX_AGE to them.
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args):
+    """
+    Run blocking code (ORM queries, saves, activity writes) in the default
+    executor so it does not stall the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(_close_connections,
+                                                              func, *args))
+
+
+# Keyed weakly, a closed and discarded loop takes its client with it.
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(loop=None):
+    """Return the Buckaroo client bound to ``loop`` (default: the current loop)."""
+    loop = loop or asyncio.get_event_loop()
+
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncBuckarooClient(
+            limit=getattr(settings, 'BUCKAROO_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE),
+            limit_per_host=getattr(settings, 'BUCKAROO_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE),
+            retry_policy=RetryPolicy.from_settings())
+        _clients[loop] = client
+    return client
+
+
+async def close_async_client(loop=None):
+    loop = loop or asyncio.get_event_loop()
+
+    client = _clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+
+
+async def async_buckaroo_api_call(transaction, url, method, data=None):
+
+    body = encode_json_body(data) if data is not None else None
+    auth = BuckarooAuth(transaction=transaction, body=body)
+
+    headers = {'Content-Type': 'application/json'}
+    logger.info(LogEvent("Async API call", transaction=transaction.id,
+                         transaction_key=transaction.transaction_key))
+
+    client = get_async_client()
+
+    with span('http', transaction, method=method, url=url):
+        if method == 'POST':
+            res = await client.request('POST', url, headers=headers, data=body, auth=auth)
+        if method == 'GET':
+            res = await client.request('GET', url, headers=headers, auth=auth)
+
+    record_status(res)
+    logger.info(LogEvent("API response", transaction=transaction.id,
+                         status_code=res.status_code, data=Payload(res.data)))
+
+    return res
+
+
+class AsyncPay(Pay):
+    """
+    ``Pay`` without blocking the loop: the Buckaroo call is awaited, the
+    database work runs in the default executor.
+    """
+
+    async def async_pay(self):
+        with span('pay', self.transaction):
+            data = await run_sync(self._verify_and_prepare_pay_json)
+
+            url = construct_url()
+
+            res = await async_buckaroo_api_call(self.transaction, url, "POST", data)
+
+            await run_sync(self._handle_transaction_response, res)
+
+    def _verify_and_prepare_pay_json(self):
+        verify_transaction_fields(transaction=self.transaction)
+        return self._prepare_pay_json()
+
+
+class AsyncRefund(Refund):
+    """``Refund`` without blocking the loop, see ``AsyncPay``."""
+
+    async def async_get_refund_info(self):
+        """Get the refund options for a transaction without blocking the loop."""
+        url = self._get_refund_info_url()
+
+        res = await async_buckaroo_api_call(self.transaction, url, 'GET')
+
+        self._update_refund_info(response=res.data)
+
+    async def async_refund(self):
+        if settings.BUCKAROO_DISABLE_REFUND:
+            return
+
+        with span('refund', self.transaction):
+            await self.async_get_refund_info()
+
+            self._check_refund_allowed()
+
+            data = await run_sync(self._prepare_refund_json)
+
+            url = construct_url()
+
+            res = await async_buckaroo_api_call(self.transaction, url, "POST", data)
+
+            await run_sync(self._handle_transaction_response, res)
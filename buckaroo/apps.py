@@ -7,3 +7,14 @@ class BuckarooConfig(AppConfig):
     def ready(self):
         from actstream import registry
         registry.register(self.get_model('Transaction'))
+
+        from .methods import load_payment_methods
+        load_payment_methods()
+
+        from .client import warm_up_client
+        warm_up_client()
+
+        from django.core.signals import request_finished, request_started
+        from .activity import close_activity_batch, open_activity_batch
+        request_started.connect(open_activity_batch, dispatch_uid='buckaroo_open_activity')
+        request_finished.connect(close_activity_batch, dispatch_uid='buckaroo_flush_activity')
@@ -1,4 +1,5 @@
 import base64
+import functools
 import hmac
 import hashlib
 import urllib.parse
@@ -6,13 +7,19 @@ import random
 import json
 import time
 
+from requests.auth import AuthBase
+
 from django.conf import settings
 
+from .tracing import span
+
+
+_system_random = random.SystemRandom()
+
 
 def generate_nonce(length=8):
-    """Generate pseudorandom number."""
-    result = ''.join([str(random.randint(0, 9)) for i in range(length)])
-    return result
+    """Generate a random number of ``length`` digits from the OS random source."""
+    return str(_system_random.randrange(10 ** length)).zfill(length)
 
 
 def generate_timestamp():
@@ -21,16 +28,99 @@ def generate_timestamp():
     return result
 
 
+def encode_json_body(json_data=None):
+    """
+    Serialize a request payload to the bytes that are both signed and sent,
+    so the content digest always matches the body on the wire.
+    """
+    return json.dumps(json_data, separators=(',', ':')).encode('utf-8')
+
+
+def get_body_md5_digest(body=b''):
+    """Generate MD5 digest from an encoded request body."""
+    return hashlib.md5(body).digest()
+
+
 def get_json_md5_digest(json_data=None):
     """Generate MD5 digest from a JSON encoded string."""
-    data = json.dumps(json_data).encode('utf-8')
-    m = hashlib.md5(data)
-    return m.digest()
+    return get_body_md5_digest(encode_json_body(json_data))
+
+
+def get_content_string(http_method, body=None):
+    """Base64 MD5 of a POST body as used in the signature, empty otherwise."""
+    if body and http_method == 'POST':
+        return base64.b64encode(get_body_md5_digest(body)).decode('utf-8')
+    return ''
+
+
+class Signer:
+    """
+    Reusable HMAC-SHA256 signing context for Buckaroo requests.
+
+    The secret key is encoded and the website key, which starts every
+    signed message, is fed to the HMAC once; each signature works on a
+    copy of that state.
+    """
+
+    def __init__(self, website_key, secret_key):
+        self.website_key = website_key
+        self._hmac = hmac.new(secret_key.encode('utf-8'), website_key.encode('utf-8'),
+                              digestmod=hashlib.sha256)
+
+    def sign(self, http_method, request_uri, request_timestamp, nonce, content=''):
+        """Base64 signature; ``content`` is the Base64 MD5 of a POST body."""
+        mac = self._hmac.copy()
+        mac.update((http_method + request_uri.lower() + str(request_timestamp) +
+                    nonce + content).encode('utf-8'))
+        return base64.b64encode(mac.digest())
+
+    def sign_many(self, messages):
+        """
+        Sign an iterable of ``(http_method, request_uri, request_timestamp,
+        nonce, content)`` tuples, e.g. for bulk refunds.
+        """
+        return [self.sign(*message) for message in messages]
+
+    def get_auth_header(self, url, http_method="POST", body=None, nonce=None,
+                        request_timestamp=None):
+        """Authorization header for a request with the encoded ``body`` to ``url``."""
+        from .utils import split_url
+
+        nonce = nonce or generate_nonce()
+        request_timestamp = request_timestamp or generate_timestamp()
+
+        signature = self.sign(http_method, urllib.parse.quote_plus(split_url(url)),
+                              request_timestamp, nonce, get_content_string(http_method, body))
+
+        return "hmac {0}:{1}:{2}:{3}".format(self.website_key, signature.decode('utf-8'),
+                                             nonce, request_timestamp)
+
+    def get_auth_headers(self, requests):
+        """Authorization headers for an iterable of ``(url, http_method, body)``."""
+        return [self.get_auth_header(url, http_method, body)
+                for url, http_method, body in requests]
+
+
+@functools.lru_cache(maxsize=8)
+def _get_signer(website_key, secret_key):
+    return Signer(website_key, secret_key)
+
+
+def get_signer():
+    """The signer for the configured keys, built once per pair of keys."""
+    return _get_signer(settings.BUCKAROO_WEBSITE_KEY, settings.BUCKAROO_SECRET_KEY)
 
 
 class AuthHeader:
-    def __init__(self, transaction=None, url=None, json=None, method="POST"):
+    """
+    Authorization header for one request. Pass the encoded ``body`` that
+    is sent; ``json`` is encoded with ``encode_json_body`` when no body is
+    given, the caller then has to send ``self.body``.
+    """
+
+    def __init__(self, transaction=None, url=None, json=None, method="POST", body=None):
         self.json = json
+        self.body = body if body is not None or json is None else encode_json_body(json)
         self.url = url
 
         self.transaction = transaction
@@ -47,45 +137,43 @@ class AuthHeader:
                        nonce=None,
                        request_timestamp=None,
                        request_uri=None,
-                       json=None):
+                       json=None,
+                       body=None):
         """Generate a Base64 hash string for the signature in the authentication header."""
 
-        request_json_base64string = ''
+        if body is None and json:
+            body = encode_json_body(json)
 
-        if json and http_method == 'POST':
-            digest = get_json_md5_digest(json_data=json)
-            request_json_base64string = base64.b64encode(digest)
-            request_json_base64string = request_json_base64string.decode('utf-8')
-
-        msg = settings.BUCKAROO_WEBSITE_KEY + http_method + \
-            request_uri.lower() + \
-            str(request_timestamp) + nonce + request_json_base64string
-
-        message = bytes(msg, "utf-8")
-
-        secret = bytes(settings.BUCKAROO_SECRET_KEY, "utf-8")
-
-        signature = base64.b64encode(hmac.new(secret,
-                                              message,
-                                              digestmod=hashlib.sha256).digest())
-        return signature
+        return get_signer().sign(http_method, request_uri, request_timestamp, nonce,
+                                 get_content_string(http_method, body))
 
     def _generate_auth_header(self):
         """
         Generate the authentication header to communicate with the
         Buckaroo API.
         """
-        from .utils import split_url
-
-        nonce = generate_nonce()
-        timestamp = generate_timestamp()
-        url = urllib.parse.quote_plus(split_url(self.url))
+        self.auth_header = get_signer().get_auth_header(self.url, self.method, self.body)
+        return self.auth_header
 
-        signature = self._get_signature(self.method, nonce, timestamp, url, self.json)
 
-        header = "hmac " + settings.BUCKAROO_WEBSITE_KEY + ":" + \
-            signature.decode('utf-8') + ":" + \
-            str(nonce) + ":" + str(timestamp)
+class BuckarooAuth(AuthBase):
+    """
+    Signs every request that is sent, so a retried request gets a fresh
+    nonce and timestamp instead of replaying the first signature.
+    """
 
-        self.auth_header = header
-        return header
+    def __init__(self, transaction=None, json=None, body=None):
+        self.transaction = transaction
+        self.json = json
+        self.body = body if body is not None or json is None else encode_json_body(json)
+
+    def get_header(self, url, method):
+        with span('sign', self.transaction):
+            return AuthHeader(transaction=self.transaction,
+                              url=url,
+                              method=method.upper(),
+                              body=self.body).get_auth_header()
+
+    def __call__(self, request):
+        request.headers['Authorization'] = self.get_header(request.url, request.method)
+        return request
@@ -0,0 +1,187 @@
+"""Process-wide HTTP client for the Buckaroo API."""
+
+import os
+import threading
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from .exceptions import BuckarooException
+from .log import LogEvent
+from .metrics import track_api_call
+from .resilience import RetryPolicy, get_circuit_breaker, get_timeout
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 32
+
+
+class BuckarooClient:
+    """
+    Wraps a single ``requests.Session`` so every Buckaroo API call reuses
+    pooled keep-alive connections instead of doing a new TCP+TLS handshake.
+
+    ``pool_connections`` is the number of per-host pools kept around and
+    ``pool_maxsize`` the number of connections kept open per host.
+
+    Requests get the configured connect/read timeouts, are retried
+    according to ``retry_policy`` and go through the process-wide circuit
+    breaker.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False, retry_policy=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retry_policy = retry_policy or RetryPolicy(retries=0)
+
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', get_timeout())
+
+        breaker = get_circuit_breaker()
+        breaker.before_call()
+
+        with track_api_call(url, method):
+            try:
+                res = self._send(method, url, **kwargs)
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled or interrupted, which says nothing about Buckaroo.
+                breaker.release()
+                raise
+
+            if res.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        return res
+
+    def _send(self, method, url, **kwargs):
+        attempt = 0
+
+        while True:
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                if not self.retry_policy.should_retry(attempt, method, exc=e):
+                    logger.error(LogEvent("Buckaroo request failed", method=method, url=url,
+                                          error=e))
+                    raise BuckarooException({"message": "Buckaroo API request failed",
+                                             "description": str(e)}) from e
+            else:
+                if not self.retry_policy.should_retry(attempt, method,
+                                                      status_code=res.status_code):
+                    return res
+
+            delay = self.retry_policy.delay(attempt)
+            attempt += 1
+            logger.warning(LogEvent("Retrying Buckaroo request", method=method, url=url,
+                                    delay=round(delay, 2), attempt=attempt))
+            time.sleep(delay)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def warm_up(self, url, connections=1):
+        """
+        Open ``connections`` keep-alive connections to the host of ``url``.
+
+        The requests run in parallel, otherwise they would all reuse the
+        first connection that was returned to the pool.
+        """
+        def _head():
+            try:
+                self.session.head(url, timeout=5)
+            except requests.RequestException as e:
+                logger.warning(LogEvent("Could not pre-warm connection", url=url, error=e))
+
+        threads = [threading.Thread(target=_head)
+                   for i in range(min(connections, self.pool_maxsize))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide Buckaroo client, creating it on first use.
+
+    A client created before a fork (e.g. pre-warmed in a preloading
+    gunicorn master) is replaced in the child, so workers never share
+    pooled connections.
+    """
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                # The parent's session is dropped, not closed: its sockets
+                # still belong to the parent.
+                _client_pid = os.getpid()
+                _client = BuckarooClient(
+                    pool_connections=getattr(settings, 'BUCKAROO_POOL_CONNECTIONS',
+                                             DEFAULT_POOL_CONNECTIONS),
+                    pool_maxsize=getattr(settings, 'BUCKAROO_POOL_MAXSIZE',
+                                         DEFAULT_POOL_MAXSIZE),
+                    pool_block=getattr(settings, 'BUCKAROO_POOL_BLOCK', False),
+                    retry_policy=RetryPolicy.from_settings())
+    return _client
+
+
+def reset_client():
+    """Close and drop the process-wide client."""
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def warm_up_client():
+    """
+    Pre-open connections to the configured Buckaroo endpoint in the
+    background, so a slow Buckaroo does not delay process startup.
+    """
+    from .utils import construct_url
+
+    connections = getattr(settings, 'BUCKAROO_POOL_PREWARM', 0)
+    if not connections:
+        return
+
+    thread = threading.Thread(target=get_client().warm_up,
+                              args=(construct_url(),),
+                              kwargs={'connections': connections})
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,102 @@
+"""Recognise Buckaroo pushes that were already accepted."""
+
+import logging
+import threading
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.utils import timezone
+
+from .models import PushReceipt
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+# Buckaroo stops re-sending a push long before this.
+DEFAULT_RECEIPT_DAYS = 30
+
+
+def get_push_key(data):
+    """(payment key, status code, push timestamp) of a push, or None if incomplete."""
+    try:
+        return (str(data['PaymentKey']),
+                int(data['Status']['Code']['Code']),
+                str(data['Status']['DateTime']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class PushDeduplicator:
+    """
+    A bounded in-process LRU cache of push keys in front of the unique
+    ``PushReceipt`` table. Repeated pushes are mostly answered from the
+    cache; the table catches the ones handled by another process.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key):
+        with self._lock:
+            self._keys[key] = True
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def _in_cache(self, key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+        return False
+
+    def is_duplicate(self, key):
+        """Record the push ``key``; True if it had been recorded before."""
+        if self._in_cache(key):
+            return True
+
+        payment_key, status_code, pushed_at = key
+        try:
+            with db_transaction.atomic():
+                PushReceipt.objects.create(payment_key=payment_key,
+                                           status_code=status_code,
+                                           pushed_at=pushed_at)
+        except IntegrityError:
+            self._remember(key)
+            return True
+
+        self._remember(key)
+        return False
+
+    def forget(self, key):
+        """Drop ``key`` again, e.g. when the push could not be queued."""
+        with self._lock:
+            self._keys.pop(key, None)
+
+        payment_key, status_code, pushed_at = key
+        PushReceipt.objects.filter(payment_key=payment_key,
+                                   status_code=status_code,
+                                   pushed_at=pushed_at).delete()
+
+
+push_deduplicator = PushDeduplicator(
+    maxsize=getattr(settings, 'BUCKAROO_PUSH_DEDUP_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+
+def prune_push_receipts(days=None):
+    """Delete receipts older than ``days``, return how many were deleted."""
+    if days is None:
+        days = getattr(settings, 'BUCKAROO_PUSH_RECEIPT_DAYS', DEFAULT_RECEIPT_DAYS)
+
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = PushReceipt.objects.filter(received__lt=cutoff).delete()
+    logger.info("Pruned {0} push receipts older than {1} days".format(deleted, days))
+    return deleted
@@ -9,3 +9,9 @@ class BuckarooException(Exception):
 class BuckarooAPIException(APIException):
     """API Exception if anything in the payment service errors."""
     status_code = 500
+
+
+class PaymentInProgress(APIException):
+    """A payment for the same order is being started by another request."""
+    status_code = 409
+    default_detail = 'A payment for this order is already being started.'
@@ -0,0 +1,98 @@
+"""
+Lazily rendered, structured log events.
+
+``LogEvent("API response", transaction=t.id, data=Payload(res.data))`` is
+cheap to create: the message is only formatted when a handler emits the
+record, so disabled levels cost no formatting or serialization. The
+fields stay available to structured formatters as ``record.msg.fields``.
+
+Payloads are rendered with card and consumer data redacted, and only for
+a ``BUCKAROO_LOG_PAYLOAD_SAMPLE_RATE`` fraction of events (default all).
+"""
+
+import json
+import random
+
+from django.conf import settings
+
+
+REDACTED = '[redacted]'
+NOT_SAMPLED = '[not sampled]'
+
+# Keys containing one of these (case-insensitive) are redacted.
+DEFAULT_REDACTED_KEYS = ('card', 'consumer', 'customer', 'payer', 'iban', 'bic', 'cvc',
+                         'cvv', 'email', 'phone', 'address')
+
+
+def get_redacted_keys():
+    return tuple(key.lower() for key in getattr(settings, 'BUCKAROO_LOG_REDACTED_KEYS',
+                                                DEFAULT_REDACTED_KEYS))
+
+
+def _is_redacted(key, redacted_keys):
+    key = str(key).lower()
+    return any(part in key for part in redacted_keys)
+
+
+def redact(data, redacted_keys=None):
+    """
+    Copy of ``data`` with the values of sensitive keys replaced. Service
+    parameters (``{'Name': 'consumerIBAN', 'Value': ...}``) are matched on
+    their ``Name``.
+    """
+    if redacted_keys is None:
+        redacted_keys = get_redacted_keys()
+
+    if isinstance(data, dict):
+        result = {key: REDACTED if _is_redacted(key, redacted_keys)
+                  else redact(value, redacted_keys)
+                  for key, value in data.items()}
+        if 'Value' in result and _is_redacted(data.get('Name', ''), redacted_keys):
+            result['Value'] = REDACTED
+        return result
+
+    if isinstance(data, (list, tuple)):
+        return [redact(value, redacted_keys) for value in data]
+
+    return data
+
+
+class Payload:
+    """A request or response body, redacted and sampled when rendered."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        rate = getattr(settings, 'BUCKAROO_LOG_PAYLOAD_SAMPLE_RATE', 1)
+        if rate < 1 and random.random() >= rate:
+            return NOT_SAMPLED
+
+        data = self.data
+        if hasattr(data, 'dict'):
+            # QueryDict
+            data = data.dict()
+
+        return json.dumps(redact(data), default=str, sort_keys=True)
+
+
+class LogEvent:
+    """A log message with ``key=value`` fields, formatted on first use."""
+
+    __slots__ = ('message', 'fields', '_rendered')
+
+    def __init__(self, message, **fields):
+        self.message = message
+        self.fields = fields
+        self._rendered = None
+
+    def __str__(self):
+        if self._rendered is None:
+            if self.fields:
+                self._rendered = self.message + ' ' + ' '.join(
+                    '{0}={1}'.format(key, value) for key, value in sorted(self.fields.items()))
+            else:
+                self._rendered = self.message
+        return self._rendered
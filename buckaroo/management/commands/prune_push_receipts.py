@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from buckaroo.dedup import prune_push_receipts
+
+
+class Command(BaseCommand):
+    help = "Delete the receipts of old Buckaroo pushes, kept to recognise re-sent pushes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Keep receipts of this many days "
+                                 "(default: BUCKAROO_PUSH_RECEIPT_DAYS or 30).")
+
+    def handle(self, *args, **options):
+        deleted = prune_push_receipts(days=options['days'])
+        self.stdout.write("Deleted {0} push receipts".format(deleted))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from buckaroo.reconcile import (Reconcile, DEFAULT_OLDER_THAN, DEFAULT_WORKERS, DEFAULT_RATE,
+                                DEFAULT_CHUNK_SIZE)
+
+
+class Command(BaseCommand):
+    help = "Ask Buckaroo for the status of transactions stuck in pending and apply it."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=DEFAULT_OLDER_THAN,
+                            help="Only transactions created at least this many minutes ago.")
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+        parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                            help="Maximum Buckaroo calls per second.")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report the statuses, do not update transactions.")
+
+    def handle(self, *args, **options):
+        report = Reconcile(older_than=options['older_than'],
+                           workers=options['workers'],
+                           rate=options['rate'],
+                           chunk_size=options['chunk_size'],
+                           dry_run=options['dry_run']).run()
+
+        for transaction_id, status in report.updated:
+            self.stdout.write("{0}: {1}".format(transaction_id, status))
+        for transaction_id, err in report.failed:
+            self.stderr.write("{0} failed: {1}".format(transaction_id, err))
+
+        self.stdout.write(str(report))
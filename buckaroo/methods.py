@@ -0,0 +1,100 @@
+"""
+Registry of the payment methods the Buckaroo actions support.
+
+Each handler validates its transaction fields, builds its ``ServiceList``
+entry and decides whether a refund is allowed. ``Pay``, ``Refund`` and
+``verify_transaction_fields`` look handlers up by
+``Transaction.payment_method``.
+
+Extra handlers are registered with ``register``, or listed as dotted paths
+in the ``BUCKAROO_PAYMENT_METHODS`` setting, which is loaded when the app
+is ready. A new method also needs an entry in ``Transaction.PAYMENT_METHODS``.
+"""
+
+import abc
+import logging
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .exceptions import BuckarooException
+from .utils import add_ideal_json, add_creditcard_json, get_bank_codes, CREDITCARD_NAMES
+
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentMethod(metaclass=abc.ABCMeta):
+    """Base payment method handler, ``name`` is the ``payment_method`` value."""
+
+    name = None
+
+    def validate(self, transaction):
+        """Raise ``BuckarooException`` when ``transaction`` misses fields."""
+
+    @abc.abstractmethod
+    def add_service_json(self, body, transaction, action):
+        """Copy of ``body`` with this method's service for ``action`` added."""
+
+    def check_refund(self, refund):
+        """Raise ``BuckarooException`` when ``refund`` is not allowed."""
+        if not refund.partial_allowed or \
+                not (refund.amount - refund.fee) <= refund.max_refund_amount:
+            logger.error("Unable to refund. Ticket price too high to refund")
+            raise BuckarooException({"message": 'Ticket price too high'})
+
+
+class Ideal(PaymentMethod):
+    name = 'ideal'
+
+    def validate(self, transaction):
+        bank_code = transaction.bank_code
+
+        if not bank_code or bank_code not in get_bank_codes():
+            raise BuckarooException({"message": "Missing or erroneous field",
+                                     "field": "bank_code"})
+
+    def add_service_json(self, body, transaction, action):
+        return add_ideal_json(body, transaction, action)
+
+
+class Creditcard(PaymentMethod):
+    name = 'creditcard'
+
+    def validate(self, transaction):
+        if (transaction.card or '').lower() not in CREDITCARD_NAMES:
+            raise BuckarooException({"message": "Missing or erroneous field",
+                                     "field": "card"})
+
+    def add_service_json(self, body, transaction, action):
+        return add_creditcard_json(body, transaction, action)
+
+
+_registry = {}
+
+
+def register(method):
+    """Register a ``PaymentMethod`` instance or class under its ``name``."""
+    if not method.name:
+        raise BuckarooException("Payment method handler {0!r} has no name".format(method))
+
+    if isinstance(method, type):
+        method = method()
+
+    _registry[method.name] = method
+    return method
+
+
+def get_payment_method(name):
+    """The handler registered for ``name``, or None."""
+    return _registry.get(name)
+
+
+def load_payment_methods():
+    """Register the handlers listed in ``BUCKAROO_PAYMENT_METHODS``."""
+    for path in getattr(settings, 'BUCKAROO_PAYMENT_METHODS', ()):
+        register(import_string(path))
+
+
+register(Ideal)
+register(Creditcard)
@@ -0,0 +1,366 @@
+"""
+In-process metrics for the Buckaroo payment flows.
+
+A small Prometheus-compatible registry, so there is no extra dependency.
+``REGISTRY.generate_text()`` renders the text exposition format and is
+served by ``views.MetricsView``. Every update is a dict lookup and a
+short lock, cheap enough for the request path.
+
+The metrics live in the memory of each process. Pushes are applied by
+the huey consumer, so their metrics are in ``WORKER_REGISTRY`` and are
+not served by the web view. With ``BUCKAROO_WORKER_METRICS_PORT`` set,
+the consumer serves both registries on that port itself (see
+``start_worker_exporter``); each process needs a port of its own.
+"""
+
+import bisect
+import logging
+import threading
+import time
+import urllib.parse
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+logger = logging.getLogger(__name__)
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                                             .replace('"', '\\"')
+                                                             .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+class Metric:
+    """A named metric with a fixed set of label names."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("{0} takes labels {1}".format(self.name, self.labelnames))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return tuple(zip(self.labelnames, key)) + extra
+
+    def samples(self):
+        """(name, labels, value) tuples for the exposition format."""
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, self._labels(key), value) for key, value in sorted(values)]
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Read the (unlabelled) value from ``function`` when collected."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            self.set(self._function())
+        return super().samples()
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per bucket counts, then sum and count.
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """(count, sum) observed for ``labels``."""
+        counts = self._values.get(self._key(labels))
+        if counts is None:
+            return 0, 0
+        return counts[-1], counts[-2]
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        samples = []
+        for key, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                self._labels(key, ('le', _format_value(bound))), cumulative))
+            samples.append((self.name + '_sum', self._labels(key), counts[-2]))
+            samples.append((self.name + '_count', self._labels(key), counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def collect(self):
+        with self._lock:
+            return list(self._metrics)
+
+    def generate_text(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.collect():
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, _format_labels(labels),
+                                                 _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Metrics only recorded by the huey consumer.
+WORKER_REGISTRY = Registry()
+
+
+api_request_duration = Histogram(
+    'buckaroo_api_request_duration_seconds',
+    "Duration of Buckaroo API calls, including retries.",
+    ('endpoint', 'method'), registry=REGISTRY)
+
+api_requests_in_flight = Gauge(
+    'buckaroo_api_requests_in_flight',
+    "Buckaroo API calls in progress.",
+    ('endpoint',), registry=REGISTRY)
+
+api_errors = Counter(
+    'buckaroo_api_errors_total',
+    "Buckaroo API calls that failed without a response.",
+    ('endpoint', 'method'), registry=REGISTRY)
+
+status_codes = Counter(
+    'buckaroo_status_codes_total',
+    "Buckaroo transaction status codes received, by source (api, push, return).",
+    ('code', 'source'), registry=REGISTRY)
+
+push_duration = Histogram(
+    'buckaroo_push_processing_seconds',
+    "Time to apply a Buckaroo push to its transaction.",
+    registry=WORKER_REGISTRY)
+
+signature_failures = Counter(
+    'buckaroo_signature_failures_total',
+    "Return POSTs rejected because of an invalid signature.",
+    registry=REGISTRY)
+
+transitions_not_allowed = Counter(
+    'buckaroo_transition_not_allowed_total',
+    "Transaction status updates refused by the state machine.",
+    ('target',), registry=REGISTRY)
+
+circuit_breaker_open = Gauge(
+    'buckaroo_circuit_breaker_open',
+    "1 while the Buckaroo circuit breaker refuses calls.",
+    registry=REGISTRY)
+
+
+def _breaker_open():
+    from .resilience import get_circuit_breaker
+
+    breaker = get_circuit_breaker()
+    return int(breaker.state != breaker.CLOSED)
+
+
+circuit_breaker_open.set_function(_breaker_open)
+
+
+ENDPOINTS = ('Transaction/RefundInfo', 'Transaction/Status', 'Transaction')
+
+
+def get_endpoint(url):
+    """Endpoint label for ``url``, without transaction keys."""
+    path = urllib.parse.urlsplit(url).path
+    for endpoint in ENDPOINTS:
+        if '/json/' + endpoint in path:
+            return endpoint
+    return 'other'
+
+
+def record_status(response, source='api'):
+    """Count the Buckaroo status code of a ``BuckarooResponse``, if any."""
+    try:
+        code = response.data['Status']['Code']['Code']
+    except (KeyError, TypeError):
+        return
+    status_codes.inc(code=code, source=source)
+
+
+@contextmanager
+def track_api_call(url, method):
+    """
+    Time a Buckaroo API call and count it as in flight. Calls the circuit
+    breaker refuses should not get here, they are neither errors nor
+    latency samples.
+    """
+    endpoint = get_endpoint(url)
+    api_requests_in_flight.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        api_errors.inc(endpoint=endpoint, method=method)
+        raise
+    finally:
+        api_requests_in_flight.dec(endpoint=endpoint)
+        api_request_duration.observe(time.perf_counter() - start,
+                                     endpoint=endpoint, method=method)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registries = (REGISTRY, WORKER_REGISTRY)
+
+    def do_GET(self):
+        body = ''.join(registry.generate_text() for registry in self.registries)
+        body = body.encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(port, addr='127.0.0.1'):
+    """Serve all metrics of this process on ``addr:port`` from a daemon thread."""
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='buckaroo-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+_worker_exporter = None
+_worker_exporter_lock = threading.Lock()
+
+
+def start_worker_exporter():
+    """
+    Start the exporter on ``BUCKAROO_WORKER_METRICS_PORT`` (bound to
+    ``BUCKAROO_WORKER_METRICS_ADDR``), once per process. The huey tasks call
+    this, so a consumer serves its metrics as soon as it runs a task.
+    """
+    global _worker_exporter
+
+    from django.conf import settings
+
+    port = getattr(settings, 'BUCKAROO_WORKER_METRICS_PORT', None)
+    if not port or _worker_exporter is not None:
+        return _worker_exporter
+
+    with _worker_exporter_lock:
+        if _worker_exporter is None:
+            addr = getattr(settings, 'BUCKAROO_WORKER_METRICS_ADDR', '127.0.0.1')
+            try:
+                _worker_exporter = start_exporter(port, addr)
+            except OSError as e:
+                # Another consumer process has the port; do not try again.
+                logger.warning("Could not serve metrics on {0}:{1}: {2}".format(addr, port, e))
+                _worker_exporter = False
+    return _worker_exporter
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Partial unique indexes: transactions that did not reach Buckaroo yet have
+# no keys, so NULL and empty keys stay out of the index.
+KEY_INDEXES = [
+    ('buckaroo_transaction_payment_key_uniq', 'payment_key'),
+    ('buckaroo_transaction_transaction_key_uniq', 'transaction_key'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckaroo', '0007_auto_20160915_1046'),
+    ]
+
+    operations = [
+        # The partial indexes have no equivalent in the model state, so
+        # they only exist in the database. The fields keep db_index off,
+        # otherwise makemigrations would add plain indexes next to them.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql=["CREATE UNIQUE INDEX {0} ON buckaroo_transaction ({1}) "
+                         "WHERE {1} IS NOT NULL AND {1} <> ''".format(name, column)
+                         for name, column in KEY_INDEXES],
+                    reverse_sql=["DROP INDEX {0}".format(name)
+                                 for name, column in KEY_INDEXES],
+                ),
+            ],
+            state_operations=[],
+        ),
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('status', 'created')]),
+        ),
+    ]
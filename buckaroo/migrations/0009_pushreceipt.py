@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckaroo', '0008_transaction_key_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushReceipt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_key', models.CharField(max_length=300)),
+                ('status_code', models.IntegerField()),
+                ('pushed_at', models.CharField(max_length=50)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='pushreceipt',
+            unique_together=set([('payment_key', 'status_code', 'pushed_at')]),
+        ),
+    ]
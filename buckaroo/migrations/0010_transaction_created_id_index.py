@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckaroo', '0009_pushreceipt'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('status', 'created'), ('created', 'id')]),
+        ),
+    ]
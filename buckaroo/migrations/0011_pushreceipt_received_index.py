@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckaroo', '0010_transaction_created_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pushreceipt',
+            name='received',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
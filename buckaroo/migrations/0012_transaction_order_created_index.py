@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buckaroo', '0011_pushreceipt_received_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('status', 'created'), ('created', 'id'),
+                                ('order', 'created', 'id')]),
+        ),
+    ]
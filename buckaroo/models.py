@@ -3,12 +3,15 @@ import logging
 
 from django.db import models
 
-from django_fsm import FSMField, transition
+from django_fsm import FSMField, TransitionNotAllowed, transition
 
 from order.models import Order
 from utils.models import TimeStampedModel
 
-from actstream import action
+from .activity import send_action
+from .log import LogEvent
+from .metrics import transitions_not_allowed
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +58,9 @@ class Transaction(TimeStampedModel):
     STATUS_REJECTED = "rejected"
 
     payment_method = models.CharField(max_length=300, choices=PAYMENT_METHODS)
+    # Both keys have a partial unique index (see migration 0008), lookups
+    # by key happen on every push and return POST. The indexes are created
+    # in SQL only, the migration state has no index for them.
     payment_key = models.CharField(max_length=300, blank=True, null=True)
     transaction_key = models.CharField(max_length=300, blank=True, null=True)
     refunded = models.BooleanField(default=False)
@@ -66,62 +72,118 @@ class Transaction(TimeStampedModel):
     bank_code = models.CharField(max_length=100, blank=True, null=True)
     last_push = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        index_together = [
+            ('status', 'created'),
+            ('created', 'id'),
+            # Cursor pagination of the transaction listing, per order.
+            ('order', 'created', 'id'),
+        ]
+
     def map_status(self, status_code=None):
-        if not status_code:
+        try:
+            return BUCKAROO_STATUS_TRANSITIONS[status_code][0]
+        except KeyError:
             return None
 
-        if status_code == BUCKAROO_190_SUCCESS:
-            return self.STATUS_SUCCESS
-
-        if status_code in (BUCKAROO_890_CANCELLED_BY_USER,
-                           BUCKAROO_891_CANCELLED_BY_MERCHANT):
-            return self.STATUS_CANCELLED
-
-        if status_code in (BUCKAROO_790_PENDING_INPUT,
-                           BUCKAROO_791_PENDING_PROCESSING,
-                           BUCKAROO_792_AWAITING_CONSUMER,
-                           BUCKAROO_793_ON_HOLD):
-            return self.STATUS_PENDING
+    def apply_status_code(self, status_code=None):
+        """
+        Run the transition for a Buckaroo status code, used by both the push
+        and the return path. Returns the resulting status, or None when the
+        code is unknown or the transition is not allowed.
+        """
+        try:
+            status, transition = BUCKAROO_STATUS_TRANSITIONS[status_code]
+        except KeyError:
+            logger.error(LogEvent("Unknown Buckaroo status code", status_code=status_code,
+                                  transaction=self.id))
+            return None
 
-        if status_code == BUCKAROO_690_REJECTED:
-            return self.STATUS_REJECTED
+        if self.status == status:
+            return status
+
+        logger.info(LogEvent("Updating transaction status", transaction=self.id,
+                             status=status))
+        try:
+            with span('fsm_transition', self, target=status):
+                transition(self)
+        except TransitionNotAllowed as e:
+            transitions_not_allowed.inc(target=status)
+            logger.error(LogEvent("Transaction status update failed", transaction=self.id,
+                                  status=status, error=e))
+            return None
 
-        if status_code in (BUCKAROO_490_FAILED,
-                           BUCKAROO_491_VALIDATION_FAILURE,
-                           BUCKAROO_492_TECHNICAL_FAILURE):
-            return self.STATUS_FAILED
+        return status
 
     @transition(field=status, source=STATUS_NEW, target=STATUS_PENDING)
     def pending(self):
-        action.send(self, verb="transitioned to pending")
+        send_action(self, verb="transitioned to pending")
 
     @transition(field=status, source=STATUS_PENDING, target=STATUS_SUCCESS)
     def success(self):
-        logger.info("Updating order {0} to 'completed'".format(self.order.id))
-        self.order.completed()
-        self.order.save()
-        action.send(self, verb="completed", target_object=self.order)
+        logger.info(LogEvent("Updating order", order=self.order_id, state='completed'))
+        with span('order_update', self):
+            self.order.completed()
+            self.order.save()
+        send_action(self, verb="completed", target_object=self.order)
 
     @transition(field=status, source=[STATUS_NEW,
                                       STATUS_PENDING], target=STATUS_FAILED)
     def failed(self):
-        logger.info("Updating order {0} to 'failed'".format(self.order.id))
-        self.order.failure()
-        self.order.save()
-        action.send(self, verb="failed", target_object=self.order)
+        logger.info(LogEvent("Updating order", order=self.order_id, state='failed'))
+        with span('order_update', self):
+            self.order.failure()
+            self.order.save()
+        send_action(self, verb="failed", target_object=self.order)
 
     @transition(field=status, source=STATUS_PENDING, target=STATUS_CANCELLED)
     def cancelled(self):
-        self.order.cancel_pay()
-        self.order.save()
-        action.send(self, verb="cancelled", target_object=self.order)
+        with span('order_update', self):
+            self.order.cancel_pay()
+            self.order.save()
+        send_action(self, verb="cancelled", target_object=self.order)
 
     @transition(field=status, source=STATUS_PENDING, target=STATUS_REJECTED)
     def rejected(self):
-        logger.info("Updating order {0} to 'failed'".format(self.order.id))
-        self.order.failure()
-        self.order.save()
-        action.send(self, verb="rejected", target_object=self.order)
+        logger.info(LogEvent("Updating order", order=self.order_id, state='failed'))
+        with span('order_update', self):
+            self.order.failure()
+            self.order.save()
+        send_action(self, verb="rejected", target_object=self.order)
 
     def __str__(self):
         return "Transaction {0} with status {1}".format(self.id, self.status)
+
+
+class PushReceipt(models.Model):
+    """A Buckaroo push that was accepted, to recognise pushes Buckaroo re-sends."""
+
+    payment_key = models.CharField(max_length=300)
+    status_code = models.IntegerField()
+    # Push timestamp as sent by Buckaroo, only compared for equality.
+    pushed_at = models.CharField(max_length=50)
+    # Old receipts are pruned by age, see ``dedup.prune_push_receipts``.
+    received = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('payment_key', 'status_code', 'pushed_at')
+
+    def __str__(self):
+        return "Push {0} for {1} at {2}".format(self.status_code, self.payment_key,
+                                                self.pushed_at)
+
+
+# Buckaroo status code -> (transaction status, transition)
+BUCKAROO_STATUS_TRANSITIONS = {
+    BUCKAROO_190_SUCCESS: (Transaction.STATUS_SUCCESS, Transaction.success),
+    BUCKAROO_490_FAILED: (Transaction.STATUS_FAILED, Transaction.failed),
+    BUCKAROO_491_VALIDATION_FAILURE: (Transaction.STATUS_FAILED, Transaction.failed),
+    BUCKAROO_492_TECHNICAL_FAILURE: (Transaction.STATUS_FAILED, Transaction.failed),
+    BUCKAROO_690_REJECTED: (Transaction.STATUS_REJECTED, Transaction.rejected),
+    BUCKAROO_790_PENDING_INPUT: (Transaction.STATUS_PENDING, Transaction.pending),
+    BUCKAROO_791_PENDING_PROCESSING: (Transaction.STATUS_PENDING, Transaction.pending),
+    BUCKAROO_792_AWAITING_CONSUMER: (Transaction.STATUS_PENDING, Transaction.pending),
+    BUCKAROO_793_ON_HOLD: (Transaction.STATUS_PENDING, Transaction.pending),
+    BUCKAROO_890_CANCELLED_BY_USER: (Transaction.STATUS_CANCELLED, Transaction.cancelled),
+    BUCKAROO_891_CANCELLED_BY_MERCHANT: (Transaction.STATUS_CANCELLED, Transaction.cancelled),
+}
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework.permissions import BasePermission
 
 
@@ -11,6 +12,21 @@ class PostOnly(BasePermission):
         return request.method == "POST"
 
 
+class MetricsAccess(BasePermission):
+    """
+    Staff users, and scrapers from the addresses in
+    ``BUCKAROO_METRICS_ALLOWED_IPS`` (none by default).
+    """
+    message = "Not allowed to read metrics."
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+
+        allowed = getattr(settings, 'BUCKAROO_METRICS_ALLOWED_IPS', ())
+        return request.META.get('REMOTE_ADDR') in allowed
+
+
 class BuckarooServer(BasePermission):
     """
     Buckaroo does a POST with transaction data.
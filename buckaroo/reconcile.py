@@ -0,0 +1,158 @@
+"""Reconcile pending transactions with Buckaroo when their push got lost."""
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction as db_transaction
+from django.utils import timezone
+
+from .activity import close_activity_batch, open_activity_batch
+from .exceptions import BuckarooException
+from .models import Transaction
+from .utils import RateLimiter, buckaroo_api_call, get_base_url, BUCKAROO_STATUS_URL
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_OLDER_THAN = 60
+DEFAULT_WORKERS = 8
+DEFAULT_RATE = 20
+DEFAULT_CHUNK_SIZE = 500
+
+
+class ReconcileReport:
+    """Outcome of a reconciliation run, as lists of transaction ids."""
+
+    def __init__(self):
+        self.updated = []
+        self.unchanged = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add(self, outcome, transaction_id, detail=None):
+        with self._lock:
+            if outcome == 'unchanged':
+                self.unchanged.append(transaction_id)
+            else:
+                getattr(self, outcome).append((transaction_id, detail))
+
+    @property
+    def processed(self):
+        return len(self.updated) + len(self.unchanged) + len(self.failed)
+
+    def __str__(self):
+        return "Updated: {0}, unchanged: {1}, failed: {2}".format(
+            len(self.updated), len(self.unchanged), len(self.failed))
+
+
+class Reconcile:
+    """
+    Asks Buckaroo for the status of transactions that are still pending
+    ``older_than`` minutes after they were created, and applies it the same
+    way a push would.
+
+    Transactions are read in primary key chunks, so memory use does not
+    depend on the number of stuck transactions. The status calls run on a
+    bounded pool of workers sharing one ``RateLimiter``. With ``dry_run``
+    the statuses are only reported; ``updated`` then lists the status each
+    transaction would get.
+    """
+
+    def __init__(self, queryset=None, older_than=DEFAULT_OLDER_THAN, workers=DEFAULT_WORKERS,
+                 rate=DEFAULT_RATE, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False,
+                 progress=None):
+        self.queryset = queryset if queryset is not None else Transaction.objects.all()
+        self.older_than = older_than
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.progress = progress
+        self.report = ReconcileReport()
+
+    def _chunks(self):
+        """Yield stuck transactions in primary key order, one chunk at a time."""
+        cutoff = timezone.now() - timedelta(minutes=self.older_than)
+        queryset = (self.queryset.filter(status=Transaction.STATUS_PENDING, created__lt=cutoff)
+                    .exclude(transaction_key__isnull=True).exclude(transaction_key='')
+                    # Everything the status call reads, the uuid for its spans.
+                    .only('id', 'transaction_key', 'status', 'uuid', 'order')
+                    .order_by('pk'))
+        last_pk = 0
+
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:self.chunk_size])
+            if not chunk:
+                return
+            last_pk = chunk[-1].pk
+            yield chunk
+
+    def get_status(self, transaction):
+        """The Buckaroo status code of ``transaction``."""
+        url = ''.join([get_base_url(), BUCKAROO_STATUS_URL, transaction.transaction_key])
+
+        self.rate_limiter.wait()
+        res = buckaroo_api_call(transaction, url, 'GET')
+
+        if res.status_code != 200:
+            raise BuckarooException({"message": 'Invalid API status code',
+                                     "description": "The request to the Buckaroo API was "
+                                     "unsuccessful",
+                                     "status": res.status_code})
+        return res.status
+
+    def apply_status(self, transaction, status_code):
+        """Apply ``status_code``, returns the new status or None if nothing changed."""
+        if self.dry_run:
+            status = transaction.map_status(status_code)
+            return status if status != transaction.status else None
+
+        with db_transaction.atomic():
+            # A push may have arrived while Buckaroo was being asked.
+            locked = (Transaction.objects.select_for_update().select_related('order')
+                      .get(pk=transaction.pk))
+            if locked.status != Transaction.STATUS_PENDING:
+                return None
+
+            status = locked.apply_status_code(status_code)
+            if status is None or status == Transaction.STATUS_PENDING:
+                return None
+
+            locked.save()
+            return status
+
+    def _reconcile_one(self, transaction):
+        open_activity_batch()
+        try:
+            status = self.apply_status(transaction, self.get_status(transaction))
+        except BuckarooException as err:
+            logger.error("Reconciling transaction {0} failed: {1}".format(transaction.id, err))
+            self.report.add('failed', transaction.id, err)
+        except Exception as err:
+            logger.exception("Reconciling transaction {0} failed".format(transaction.id))
+            self.report.add('failed', transaction.id, err)
+        else:
+            if status is None:
+                self.report.add('unchanged', transaction.id)
+            else:
+                logger.info("Reconciled transaction {0} to {1}{2}".format(
+                    transaction.id, status, " (dry run)" if self.dry_run else ""))
+                self.report.add('updated', transaction.id, status)
+        finally:
+            close_activity_batch()
+            close_old_connections()
+
+        if self.progress:
+            self.progress(self.report)
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk in self._chunks():
+                list(executor.map(self._reconcile_one, chunk))
+
+        logger.info("Reconciliation finished. {0}".format(self.report))
+        return self.report
@@ -0,0 +1,140 @@
+"""Refund many transactions at once, e.g. for a cancelled event."""
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .actions import Refund
+from .activity import close_activity_batch, open_activity_batch
+from .exceptions import BuckarooException
+from .models import BUCKAROO_793_ON_HOLD
+from .utils import RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_RATE = 20
+DEFAULT_CHUNK_SIZE = 500
+
+
+class BulkRefundReport:
+    """Outcome of a bulk refund, as lists of transaction ids."""
+
+    def __init__(self):
+        self.refunded = []
+        self.on_hold = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add(self, outcome, transaction_id, error=None):
+        with self._lock:
+            if outcome == 'failed':
+                self.failed.append((transaction_id, error))
+            else:
+                getattr(self, outcome).append(transaction_id)
+
+    @property
+    def processed(self):
+        return len(self.refunded) + len(self.on_hold) + len(self.failed)
+
+    def __str__(self):
+        return "Refunded: {0}, on hold: {1}, failed: {2}".format(
+            len(self.refunded), len(self.on_hold), len(self.failed))
+
+
+def get_order_total(transaction):
+    return transaction.order.total
+
+
+def fixed_amount(amount):
+    def get_amount(transaction):
+        return amount
+    return get_amount
+
+
+class BulkRefund:
+    """
+    Refunds a queryset of transactions with a bounded pool of workers.
+
+    Every transaction still does its RefundInfo GET and refund POST, but
+    transactions are handled concurrently and all calls share one
+    ``RateLimiter`` towards Buckaroo. Transactions that are already
+    ``refunded`` are skipped, so an interrupted run can simply be started
+    again with the same queryset.
+
+    ``get_amount`` is the amount to refund: a callable taking the
+    transaction, or a number used for every transaction. By default the
+    order total is refunded.
+    """
+
+    def __init__(self, queryset=None, get_amount=None, workers=DEFAULT_WORKERS,
+                 rate=DEFAULT_RATE, chunk_size=DEFAULT_CHUNK_SIZE, testing=None,
+                 progress=None):
+        self.queryset = queryset
+        if get_amount is None:
+            get_amount = get_order_total
+        elif not callable(get_amount):
+            get_amount = fixed_amount(get_amount)
+        self.get_amount = get_amount
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.testing = settings.BUCKAROO_TEST_MODE if testing is None else testing
+        self.progress = progress
+        self.report = BulkRefundReport()
+
+    def _chunks(self):
+        """Yield pending transactions in primary key order, one chunk at a time."""
+        queryset = self.queryset.filter(refunded=False).select_related('order').order_by('pk')
+        last_pk = 0
+
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:self.chunk_size])
+            if not chunk:
+                return
+            last_pk = chunk[-1].pk
+            yield chunk
+
+    def _refund_one(self, transaction):
+        open_activity_batch()
+        try:
+            refund = Refund(transaction=transaction,
+                            amount=self.get_amount(transaction),
+                            testing=self.testing,
+                            rate_limiter=self.rate_limiter)
+            refund.refund()
+        except BuckarooException as err:
+            logger.error("Bulk refund of transaction {0} failed: {1}".format(transaction.id, err))
+            self.report.add('failed', transaction.id, err)
+        except Exception as err:
+            logger.exception("Bulk refund of transaction {0} failed".format(transaction.id))
+            self.report.add('failed', transaction.id, err)
+        else:
+            if refund.b_status_code == BUCKAROO_793_ON_HOLD:
+                self.report.add('on_hold', transaction.id)
+            else:
+                self.report.add('refunded', transaction.id)
+        finally:
+            close_activity_batch()
+            close_old_connections()
+
+        if self.progress:
+            self.progress(self.report)
+
+    def run(self):
+        if settings.BUCKAROO_DISABLE_REFUND:
+            logger.warning("Refunds are disabled, bulk refund not started")
+            return self.report
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk in self._chunks():
+                list(executor.map(self._refund_one, chunk))
+
+        logger.info("Bulk refund finished. {0}".format(self.report))
+        return self.report
@@ -0,0 +1,194 @@
+"""Retry and circuit breaker policy for calls to the Buckaroo API."""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from django.conf import settings
+
+from .exceptions import BuckarooException
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.2
+DEFAULT_RETRY_MAX_BACKOFF = 5
+DEFAULT_CIRCUIT_FAILURES = 5
+DEFAULT_CIRCUIT_RESET = 30
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def get_timeout():
+    """(connect, read) timeout in seconds for Buckaroo calls."""
+    return (getattr(settings, 'BUCKAROO_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            getattr(settings, 'BUCKAROO_READ_TIMEOUT', DEFAULT_READ_TIMEOUT))
+
+
+def request_not_sent(exc):
+    """True when ``exc`` happened before the request could reach Buckaroo."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        reason = getattr(exc.args[0], 'reason', exc.args[0])
+        return isinstance(reason, NewConnectionError)
+
+    return False
+
+
+class RetryPolicy:
+    """
+    Idempotency-aware retries with full-jitter exponential backoff.
+
+    GETs (RefundInfo, status) are retried on connection errors, timeouts and
+    5xx responses. POSTs create payments and refunds, so they are only
+    retried when the request was never sent.
+    """
+
+    def __init__(self, retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_RETRY_BACKOFF,
+                 max_backoff=DEFAULT_RETRY_MAX_BACKOFF):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_settings(cls):
+        return cls(retries=getattr(settings, 'BUCKAROO_MAX_RETRIES', DEFAULT_MAX_RETRIES),
+                   backoff=getattr(settings, 'BUCKAROO_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF),
+                   max_backoff=getattr(settings, 'BUCKAROO_RETRY_MAX_BACKOFF',
+                                       DEFAULT_RETRY_MAX_BACKOFF))
+
+    def should_retry(self, attempt, method, exc=None, status_code=None, not_sent=None):
+        """
+        ``not_sent`` tells whether a failed request never reached Buckaroo,
+        by default it is derived from the requests exception ``exc``.
+        """
+        if attempt >= self.retries:
+            return False
+
+        if exc is not None:
+            if not_sent is None:
+                not_sent = request_not_sent(exc)
+            return method == 'GET' or not_sent
+
+        return method == 'GET' and status_code in RETRY_STATUS_CODES
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails fast while Buckaroo is degraded.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls are refused for ``reset_timeout`` seconds. Then one trial call is
+    let through (half open): success closes the breaker, failure opens it
+    again. A trial that reports no outcome within ``reset_timeout`` is
+    given up and the next call becomes the trial.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=DEFAULT_CIRCUIT_FAILURES,
+                 reset_timeout=DEFAULT_CIRCUIT_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise BuckarooException({"message": "Buckaroo API unavailable",
+                                             "description": "Circuit breaker is open"})
+                self.state = self.HALF_OPEN
+                self.trial_started_at = time.monotonic()
+            elif self.state == self.HALF_OPEN:
+                # Only one trial call at a time.
+                if self.trial_started_at is not None and \
+                        time.monotonic() - self.trial_started_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise BuckarooException({"message": "Buckaroo API unavailable",
+                                             "description": "Circuit breaker is half open"})
+                if self.trial_started_at is not None:
+                    logger.warning("Buckaroo circuit breaker trial call timed out")
+                self.trial_started_at = time.monotonic()
+
+    def release(self):
+        """
+        A call ended without an outcome (e.g. it was cancelled): free the
+        trial slot when half open, without counting a failure.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_started_at = None
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning("Buckaroo circuit breaker closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    logger.warning("Buckaroo circuit breaker opened after {0} failures"
+                                   .format(self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        return dict(state=self.state,
+                    failures=self.failures,
+                    times_opened=self.times_opened,
+                    rejected=self.rejected)
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """Return the process-wide circuit breaker for the Buckaroo API."""
+    global _breaker
+
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=getattr(settings, 'BUCKAROO_CIRCUIT_FAILURES',
+                                              DEFAULT_CIRCUIT_FAILURES),
+                    reset_timeout=getattr(settings, 'BUCKAROO_CIRCUIT_RESET',
+                                          DEFAULT_CIRCUIT_RESET))
+    return _breaker
+
+
+def reset_circuit_breaker():
+    global _breaker
+
+    with _breaker_lock:
+        _breaker = None
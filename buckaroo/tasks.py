@@ -1,11 +1,56 @@
 from huey.contrib.djhuey import task
+from django.db import transaction as db_transaction
 import logging
 
+from .activity import activity_batch, write_activity_records
+from .log import LogEvent
+from .metrics import push_duration, start_worker_exporter
+from .tracing import span
+from .models import Transaction
+from .utils import update_transaction
+
 
 logger = logging.getLogger("huey")
 
 
+@task(retries=3, retry_delay=10)
+def process_push(data):
+    """Apply a Buckaroo push (the 'Transaction' part of the payload)."""
+    start_worker_exporter()
+    logger.info(LogEvent("Processing Buckaroo push", payment_key=data['PaymentKey']))
+
+    with activity_batch(), push_duration.time(), db_transaction.atomic():
+        try:
+            transaction = Transaction.objects.select_for_update().get(
+                payment_key=data['PaymentKey'])
+        except Transaction.DoesNotExist:
+            logger.warning(LogEvent("Transaction not found",
+                                    payment_key=data['PaymentKey']))
+            return
+
+        with span('push', transaction):
+            update_transaction(transaction=transaction, data=data)
+
+
+@task(retries=3, retry_delay=10)
+def write_activity(records):
+    """Write activity stream records buffered by the outbox."""
+    write_activity_records(records)
+
+
+@task()
+def reconcile_pending(older_than=None):
+    """Reconcile transactions that are stuck in pending, see ``buckaroo.reconcile``."""
+    from .reconcile import Reconcile, DEFAULT_OLDER_THAN
+
+    start_worker_exporter()
+    report = Reconcile(older_than=older_than or DEFAULT_OLDER_THAN).run()
+    logger.info(LogEvent("Buckaroo reconciliation finished", report=report))
+
+
 @task()
-def buckaroo_api_call(*args, **kwargs):
-    logger.info('Huey Buckaroo API call')
-    print("Woohoo! Buckaroo HUEY call **********")
+def prune_push_receipts(days=None):
+    """Delete old push receipts, see ``buckaroo.dedup``."""
+    from . import dedup
+
+    dedup.prune_push_receipts(days=days)
@@ -0,0 +1,74 @@
+import os
+import tracemalloc
+
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TESTS_DIR = os.path.join(PACKAGE_DIR, 'tests')
+
+
+def retained_blocks(before, after):
+    """Memory blocks allocated by buckaroo code (not its tests) and still alive."""
+    return sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'filename')
+               if stat.traceback[0].filename.startswith(PACKAGE_DIR) and
+               not stat.traceback[0].filename.startswith(TESTS_DIR))
+
+
+@pytest.fixture
+def measure(benchmark, db):
+    """
+    Benchmark ``func`` and check the budgets of a single call.
+
+    Query counts and retained allocations do not depend on the machine, so
+    unlike the timings they are asserted: at most ``max_queries`` database
+    queries, and at most ``max_retained`` memory blocks allocated by
+    buckaroo and kept after the call (None skips the check). One warm-up
+    call fills the process-wide caches first. Both numbers, the total
+    allocations and the peak memory are also kept in ``extra_info``.
+
+    ``setup`` runs before every call, as in ``benchmark.pedantic``; it may
+    return the ``(args, kwargs)`` to call ``func`` with.
+    """
+    def _measure(func, *args, setup=None, max_queries=0, max_retained=0, **kwargs):
+        def call():
+            call_args, call_kwargs = args, kwargs
+            if setup is not None:
+                prepared = setup()
+                if prepared is not None:
+                    call_args, call_kwargs = prepared
+            return func(*call_args, **call_kwargs)
+
+        call()
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        with CaptureQueriesContext(connection) as queries:
+            call()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        retained = retained_blocks(before, after)
+        benchmark.extra_info['allocations'] = sum(max(s.count_diff, 0)
+                                                  for s in after.compare_to(before, 'filename'))
+        benchmark.extra_info['retained'] = retained
+        benchmark.extra_info['peak_bytes'] = peak
+        benchmark.extra_info['queries'] = len(queries.captured_queries)
+
+        assert len(queries.captured_queries) <= max_queries, queries.captured_queries
+        if max_retained is not None:
+            assert retained <= max_retained
+
+        if setup is None:
+            return benchmark(func, *args, **kwargs)
+
+        def pedantic_setup():
+            prepared = setup()
+            return prepared if prepared is not None else (args, kwargs)
+
+        return benchmark.pedantic(func, setup=pedantic_setup, rounds=100, iterations=1)
+    return _measure
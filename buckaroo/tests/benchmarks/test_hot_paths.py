@@ -0,0 +1,155 @@
+"""
+Benchmarks for the code that runs on every payment, push and return.
+
+Latency comes from pytest-benchmark. The query count and the retained
+allocations of one call are asserted against a budget (see ``measure``),
+so regressions fail the run on any machine.
+"""
+import hashlib
+import urllib.parse
+
+import pytest
+
+from rest_framework.test import APIRequestFactory
+
+from order.models import Order
+
+from ...auth import AuthHeader, get_signer
+from ...models import Transaction, BUCKAROO_190_SUCCESS, BUCKAROO_790_PENDING_INPUT
+from ...utils import (verify_buckaroo_signature, update_transaction_post, add_pay_json,
+                      add_ideal_json, add_creditcard_json, add_refund_json,
+                      get_base_transaction_json)
+from ...views import PushView
+from ..factories import TransactionFactory
+from ..server import sign_return_data
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture
+def return_data(buckaroo_settings):
+    """A realistic return POST of 40 fields."""
+    data = {'BRQ_STATUSCODE': str(BUCKAROO_190_SUCCESS),
+            'BRQ_PAYMENT_METHOD': 'ideal',
+            'BRQ_TIMESTAMP': '2016-09-06 16:06:54',
+            'BRQ_TRANSACTIONS': '0475B403C11A4AB4A5F69ACBCAA2C3D1',
+            'BRQ_CUSTOMER_NAME': 'J. de Tèster',
+            'BRQ_AMOUNT': '150.00'}
+    for i in range(len(data), 40):
+        data['BRQ_FIELD_{0:02d}'.format(i)] = 'value {0}'.format(i)
+    return sign_return_data(data, buckaroo_settings.BUCKAROO_SECRET_KEY)
+
+
+def legacy_verify_buckaroo_signature(data, secret_key):
+    """The verifier before it streamed into the hash, kept as a reference."""
+    urlencoded_signature = "".join(['{0}={1}'.format(k, v) for k, v in sorted(data.items())
+                                    if k is not None and (k.startswith("BRQ_") or
+                                    k.startswith("ADD_") or k.startswith("CUST_")) and
+                                    not k.startswith("BRQ_SIGNATURE")]) + secret_key
+    raw_signature = urllib.parse.unquote(urlencoded_signature)
+    signature = hashlib.sha1(raw_signature.encode('utf-8')).hexdigest()
+    return data.get('BRQ_SIGNATURE') == signature
+
+
+@pytest.mark.benchmark(group='verify_buckaroo_signature')
+def test_verify_buckaroo_signature(measure, return_data):
+    assert measure(verify_buckaroo_signature, return_data)
+
+
+@pytest.mark.benchmark(group='verify_buckaroo_signature')
+def test_verify_buckaroo_signature_legacy(measure, buckaroo_settings, return_data):
+    assert measure(legacy_verify_buckaroo_signature, return_data,
+                   buckaroo_settings.BUCKAROO_SECRET_KEY)
+
+
+def test_auth_header_post(measure, buckaroo_settings, ideal_transaction):
+    ideal_transaction.save()
+    body = get_base_transaction_json(ideal_transaction)
+
+    def sign():
+        return AuthHeader(transaction=ideal_transaction,
+                          url='https://testcheckout.buckaroo.nl/json/Transaction/',
+                          json=body).get_auth_header()
+
+    assert measure(sign).startswith('hmac ')
+
+
+def test_auth_header_get(measure, buckaroo_settings, transaction):
+    def sign():
+        return AuthHeader(transaction=transaction,
+                          url='https://testcheckout.buckaroo.nl/json/Transaction/RefundInfo/'
+                              'ABC',
+                          method='GET').get_auth_header()
+
+    assert measure(sign).startswith('hmac ')
+
+
+def test_sign_refund_batch(measure, buckaroo_settings):
+    requests = [('https://testcheckout.buckaroo.nl/json/Transaction/RefundInfo/{0}'.format(i),
+                 'GET', None) for i in range(1000)]
+
+    assert len(measure(get_signer().get_auth_headers, requests)) == 1000
+
+
+def test_ideal_pay_payload(measure, settings, ideal_transaction):
+    settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+
+    def build():
+        body = add_pay_json(get_base_transaction_json(ideal_transaction), ideal_transaction)
+        return add_ideal_json(body, ideal_transaction, 'pay')
+
+    assert measure(build)['Services']['ServiceList']
+
+
+def test_creditcard_pay_payload(measure, cc_transaction):
+    def build():
+        body = add_pay_json(get_base_transaction_json(cc_transaction), cc_transaction)
+        return add_creditcard_json(body, cc_transaction, 'pay')
+
+    assert measure(build)['Services']['ServiceList']
+
+
+def test_ideal_refund_payload(measure, settings, ideal_transaction):
+    settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+
+    def build():
+        body = add_refund_json(get_base_transaction_json(ideal_transaction),
+                               ideal_transaction, 10)
+        return add_ideal_json(body, ideal_transaction, 'refund')
+
+    assert measure(build)['AmountCredit'] == 10
+
+
+def test_update_transaction_post(measure):
+    """
+    A pending transaction settling on return. Every round starts pending, so
+    the transition is measured: the transaction with its order and event,
+    the order save, the activity and the transaction save.
+    """
+    transaction = TransactionFactory.create(status='pending', order__state='pending')
+    data = dict(BRQ_TRANSACTIONS=transaction.transaction_key,
+                BRQ_STATUSCODE=BUCKAROO_190_SUCCESS)
+
+    def reset():
+        Transaction.objects.filter(pk=transaction.pk).update(status='pending')
+        Order.objects.filter(pk=transaction.order_id).update(state='pending')
+
+    result = measure(update_transaction_post, data, setup=reset, max_queries=4,
+                     max_retained=None)
+    assert result.status == transaction.STATUS_SUCCESS
+
+
+def test_push_view(measure, monkeypatch):
+    """The view only, queueing the huey task is left out."""
+    monkeypatch.setattr('buckaroo.views.process_push', lambda data: None)
+
+    factory = APIRequestFactory()
+    view = PushView.as_view()
+    data = {'Transaction': {'PaymentKey': 'ABC',
+                            'Status': {'Code': {'Code': BUCKAROO_790_PENDING_INPUT}}}}
+
+    def push():
+        request = factory.post('/buckaroo/push', data, format='json', HTTP_HOST='buckaroo.com')
+        return view(request)
+
+    assert measure(push, max_retained=None).status_code == 200
@@ -0,0 +1,62 @@
+"""
+Lookup cost of the push and return-URL queries.
+
+Run with ``py.test buckaroo/tests/benchmarks --benchmark-only``. The
+unindexed ``redirect_url`` column (same type and size as the keys) stands
+in for the lookups as they were before migration 0008.
+"""
+import os
+import pytest
+
+from django.db import connection
+
+from order.tests.factories import OrderFactory
+from ...models import Transaction
+
+pytest.importorskip('pytest_benchmark')
+
+
+ROWS = int(os.environ.get('BUCKAROO_BENCH_ROWS', 20000))
+
+
+@pytest.fixture
+def transactions(db):
+    order = OrderFactory.create()
+    Transaction.objects.bulk_create(
+        Transaction(order=order,
+                    payment_key='PK{0:032d}'.format(i),
+                    transaction_key='TK{0:032d}'.format(i),
+                    redirect_url='RU{0:032d}'.format(i))
+        for i in range(ROWS))
+    return ROWS
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return '\n'.join(str(row) for row in cursor.fetchall())
+
+
+@pytest.mark.parametrize('field', ['payment_key', 'transaction_key', 'redirect_url'])
+def test_key_lookup(benchmark, transactions, field):
+    value = '{0}{1:032d}'.format(dict(payment_key='PK', transaction_key='TK',
+                                      redirect_url='RU')[field], transactions // 2)
+    lookup = {field: value}
+
+    benchmark.extra_info['rows'] = transactions
+    benchmark.extra_info['plan'] = explain(Transaction.objects.filter(**lookup))
+
+    result = benchmark(Transaction.objects.get, **lookup)
+
+    assert getattr(result, field) == value
+
+
+def test_status_created_lookup(benchmark, transactions):
+    queryset = Transaction.objects.filter(status=Transaction.STATUS_PENDING).order_by('created')
+
+    benchmark.extra_info['rows'] = transactions
+    benchmark.extra_info['plan'] = explain(queryset)
+
+    benchmark(lambda: list(queryset[:100]))
@@ -1,4 +1,4 @@
-from .fixtures import transaction, transaction_pending, no_buckaroo_settings, buckaroo_settings, ideal_transaction, cc_transaction, no_website_settings, no_checkout_settings, no_secret_settings  # noqa
+from .fixtures import transaction, transaction_pending, no_buckaroo_settings, buckaroo_settings, ideal_transaction, cc_transaction, no_website_settings, no_checkout_settings, no_secret_settings, buckaroo_server  # noqa
 
 from order.tests.fixtures import order, pending_order  # noqa
 from utils.tests.fixtures import user  # noqa
@@ -1,6 +1,7 @@
 import pytest
 
 from .factories import TransactionFactory
+from .server import BuckarooStandIn
 
 
 @pytest.fixture
@@ -68,3 +69,14 @@ def no_buckaroo_settings(request, settings):
     del settings.BUCKAROO_SECRET_KEY
     del settings.BUCKAROO_CHECKOUT_URL
     return settings
+
+
+@pytest.fixture
+def buckaroo_server(request, buckaroo_settings):
+    """Local Buckaroo stand-in, the app is pointed at it."""
+    server = BuckarooStandIn(website_key=buckaroo_settings.BUCKAROO_WEBSITE_KEY,
+                             secret_key=buckaroo_settings.BUCKAROO_SECRET_KEY).start()
+    request.addfinalizer(server.stop)
+
+    buckaroo_settings.BUCKAROO_BASE_URL = server.url
+    return server
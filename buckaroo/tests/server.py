@@ -0,0 +1,323 @@
+"""
+Local stand-in for the Buckaroo JSON API, for offline load tests.
+
+Serves the Transaction, RefundInfo and Status endpoints, checks the ``hmac``
+Authorization header the way ``buckaroo.auth.AuthHeader`` builds it, and
+can send push callbacks and return POSTs to the application. Latency,
+error rate and the Buckaroo status codes it answers with are configurable.
+
+Point the app at it with ``BUCKAROO_BASE_URL = server.url``, or run it on
+its own::
+
+    python -m buckaroo.tests.server --port 8089 --latency 0.05 --status 790
+
+This module does not import Django, so it can run outside the project.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+
+SUCCESS = 190
+PENDING_INPUT = 790
+
+CHECKOUT_PATH = '/json/Transaction/'
+REFUND_INFO_PATH = '/json/Transaction/RefundInfo/'
+STATUS_PATH = '/json/Transaction/Status/'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def get_signature(website_key, secret_key, method, uri, nonce, timestamp, body=b''):
+    """Same signature as ``AuthHeader``, computed from the raw request."""
+    content = ''
+    if body and method == 'POST':
+        content = base64.b64encode(hashlib.md5(body).digest()).decode('utf-8')
+
+    msg = website_key + method + urllib.parse.quote_plus(uri).lower() + \
+        str(timestamp) + nonce + content
+
+    return base64.b64encode(hmac.new(secret_key.encode('utf-8'),
+                                     msg.encode('utf-8'),
+                                     digestmod=hashlib.sha256).digest()).decode('utf-8')
+
+
+def sign_return_data(data, secret_key):
+    """Add the ``BRQ_SIGNATURE`` Buckaroo puts on return and push POSTs."""
+    encoded = "".join("{0}={1}".format(k, v) for k, v in sorted(data.items())) + secret_key
+    signed = dict(data)
+    signed['BRQ_SIGNATURE'] = hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+    return signed
+
+
+class BuckarooHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.stand_in.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, data, http_status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(http_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _check_auth(self, method, body):
+        stand_in = self.server.stand_in
+        if not stand_in.check_auth:
+            return True
+
+        header = self.headers.get('Authorization', '')
+        try:
+            scheme, credentials = header.split(' ', 1)
+            website_key, signature, nonce, timestamp = credentials.split(':')
+        except ValueError:
+            return False
+
+        if scheme != 'hmac' or website_key != stand_in.website_key:
+            return False
+
+        uri = self.headers.get('Host', '') + self.path
+        expected = get_signature(stand_in.website_key, stand_in.secret_key, method,
+                                 uri, nonce, timestamp, body)
+        return hmac.compare_digest(expected, signature)
+
+    def _handle(self, method):
+        stand_in = self.server.stand_in
+        body = self._read_body()
+
+        with stand_in.lock:
+            stand_in.requests += 1
+
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+
+        if not self._check_auth(method, body):
+            with stand_in.lock:
+                stand_in.auth_failures += 1
+            return self._send_json({'Message': 'Authorization failed'}, 401)
+
+        if stand_in.error_rate and stand_in.random.random() < stand_in.error_rate:
+            return self._send_json({'Message': 'Internal server error'}, 500)
+
+        if method == 'POST' and self.path.rstrip('/') == CHECKOUT_PATH.rstrip('/'):
+            return self._send_json(*stand_in.transaction(json.loads(body.decode('utf-8'))))
+
+        if method == 'GET' and self.path.startswith(REFUND_INFO_PATH):
+            return self._send_json(*stand_in.refund_info(self.path[len(REFUND_INFO_PATH):]))
+
+        if method == 'GET' and self.path.startswith(STATUS_PATH):
+            return self._send_json(*stand_in.transaction_status(self.path[len(STATUS_PATH):]))
+
+        return self._send_json({'Message': 'Not found'}, 404)
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        # Used to pre-warm pooled connections.
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class BuckarooStandIn:
+    """
+    ``status_codes`` and ``refund_status_codes`` are the Buckaroo codes
+    returned for payments and refunds; with more than one, each response
+    picks one at random. The Status endpoint answers with the code set by
+    ``set_status``, or one of ``settled_status_codes``. ``http_status`` is
+    the HTTP status of successful responses, ``error_rate`` the fraction
+    answered with a 500 instead.
+    """
+
+    def __init__(self, website_key='12345', secret_key='54321', host='127.0.0.1', port=0,
+                 latency=0, error_rate=0, status_codes=(PENDING_INPUT,),
+                 refund_status_codes=(SUCCESS,), settled_status_codes=(SUCCESS,),
+                 http_status=200, check_auth=True, seed=None, verbose=False):
+        self.website_key = website_key
+        self.secret_key = secret_key
+        self.latency = latency
+        self.error_rate = error_rate
+        self.status_codes = tuple(status_codes)
+        self.refund_status_codes = tuple(refund_status_codes)
+        self.settled_status_codes = tuple(settled_status_codes)
+        self.http_status = http_status
+        self.check_auth = check_auth
+        self.verbose = verbose
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.transactions = {}
+        self.statuses = {}
+        self.requests = 0
+        self.auth_failures = 0
+
+        self.server = ThreadingHTTPServer((host, port), BuckarooHandler)
+        self.server.stand_in = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _status(self, code):
+        return {'Code': {'Code': code, 'Description': 'Stand-in status'},
+                'DateTime': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def transaction(self, body):
+        key = uuid.uuid4().hex.upper()
+
+        if 'AmountCredit' in body:
+            code = self.random.choice(self.refund_status_codes)
+            response = {'Key': key, 'Status': self._status(code),
+                        'Invoice': body.get('Invoice'),
+                        'AmountCredit': body['AmountCredit']}
+            return response, self.http_status
+
+        code = self.random.choice(self.status_codes)
+        payment_key = uuid.uuid4().hex.upper()
+
+        with self.lock:
+            self.transactions[key] = dict(body, Key=key, PaymentKey=payment_key)
+
+        response = {'Key': key,
+                    'PaymentKey': payment_key,
+                    'Status': self._status(code),
+                    'RequiredAction': {'Name': 'Redirect',
+                                       'RedirectURL': '{0}redirect/{1}'.format(self.url, key)},
+                    'Invoice': body.get('Invoice'),
+                    'AmountDebit': body.get('AmountDebit')}
+        return response, self.http_status
+
+    def refund_info(self, key):
+        with self.lock:
+            transaction = self.transactions.get(key)
+
+        amount = transaction.get('AmountDebit', 0) if transaction else 1000
+        return ({'IsRefundable': True,
+                 'MaximumRefundAmount': amount,
+                 'AllowPartialRefund': True,
+                 'RefundedAmount': 0}, self.http_status)
+
+    def set_status(self, key, status_code):
+        """Status code the Status endpoint reports for transaction ``key``."""
+        with self.lock:
+            self.statuses[key] = status_code
+
+    def transaction_status(self, key):
+        with self.lock:
+            code = self.statuses.get(key)
+            transaction = self.transactions.get(key, {})
+
+        if code is None:
+            code = self.random.choice(self.settled_status_codes)
+
+        return ({'Key': key,
+                 'PaymentKey': transaction.get('PaymentKey'),
+                 'Status': self._status(code),
+                 'Invoice': transaction.get('Invoice')}, self.http_status)
+
+    def send_push(self, push_url, key, status_code=SUCCESS, **kwargs):
+        """POST a push update for transaction ``key`` to the application."""
+        with self.lock:
+            transaction = self.transactions.get(key, {})
+
+        data = {'Transaction': {'Key': key,
+                                'PaymentKey': transaction.get('PaymentKey'),
+                                'Invoice': transaction.get('Invoice'),
+                                'Status': self._status(status_code)}}
+        return requests.post(push_url, json=data, **kwargs)
+
+    def send_return(self, return_url, key, status_code=SUCCESS, **kwargs):
+        """POST the signed return data, like Buckaroo does for the consumer."""
+        with self.lock:
+            transaction = self.transactions.get(key, {})
+
+        data = {'BRQ_STATUSCODE': status_code,
+                'BRQ_TRANSACTIONS': key,
+                'BRQ_INVOICENUMBER': transaction.get('Invoice', ''),
+                'BRQ_WEBSITEKEY': self.website_key,
+                'BRQ_TIMESTAMP': time.strftime('%Y-%m-%d %H:%M:%S')}
+        kwargs.setdefault('allow_redirects', False)
+        return requests.post(return_url, data=sign_return_data(data, self.secret_key),
+                             **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--website-key', default='12345')
+    parser.add_argument('--secret-key', default='54321')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--status', type=int, action='append', dest='status_codes')
+    parser.add_argument('--refund-status', type=int, action='append',
+                        dest='refund_status_codes')
+    parser.add_argument('--settled-status', type=int, action='append',
+                        dest='settled_status_codes')
+    parser.add_argument('--no-auth', action='store_false', dest='check_auth')
+    args = parser.parse_args()
+
+    stand_in = BuckarooStandIn(website_key=args.website_key,
+                               secret_key=args.secret_key,
+                               host=args.host,
+                               port=args.port,
+                               latency=args.latency,
+                               error_rate=args.error_rate,
+                               status_codes=args.status_codes or (PENDING_INPUT,),
+                               refund_status_codes=args.refund_status_codes or (SUCCESS,),
+                               settled_status_codes=args.settled_status_codes or (SUCCESS,),
+                               check_auth=args.check_auth,
+                               verbose=True)
+    print("Buckaroo stand-in listening on {0}".format(stand_in.url))
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 
 from ..models import BUCKAROO_790_PENDING_INPUT, BUCKAROO_190_SUCCESS
 from ..actions import Pay, Refund
 from ..exceptions import BuckarooException
 
-from .test_unit import Response
+from ..utils import BuckarooResponse
+
+
+def api_response(status_code=None, PaymentKey=1235, Key=54321, **data):
+    return BuckarooResponse(status_code=status_code,
+                            data=dict(data, PaymentKey=PaymentKey, Key=Key))
 
 
 @pytest.mark.django_db(transaction=False)
@@ -17,7 +24,7 @@ class TestPay:
                  status.HTTP_500_INTERNAL_SERVER_ERROR]
 
         for code in codes:
-            res = Response(status_code=code)
+            res = api_response(status_code=code)
             with pytest.raises(BuckarooException) as err:
                 Pay(transaction=transaction,
                     testing=True)._handle_transaction_response(response=res)
@@ -25,8 +32,8 @@ class TestPay:
 
     def test_valid_api_statuscode_invalid_buckaroo_statuscode(self, transaction):
 
-        res = Response(status_code=status.HTTP_200_OK,
-                       Status={'Code': {'Code': status.HTTP_500_INTERNAL_SERVER_ERROR}})
+        res = api_response(status_code=status.HTTP_200_OK,
+                           Status={'Code': {'Code': status.HTTP_500_INTERNAL_SERVER_ERROR}})
 
         with pytest.raises(BuckarooException) as err:
             Pay(transaction=transaction,
@@ -41,9 +48,9 @@ class TestPay:
         assert transaction.status == 'new'
         assert transaction.redirect_url is None
 
-        res = Response(status_code=status.HTTP_200_OK,
-                       RequiredAction={'RedirectURL': r_url},
-                       Status={'Code': {'Code': BUCKAROO_790_PENDING_INPUT}})
+        res = api_response(status_code=status.HTTP_200_OK,
+                           RequiredAction={'RedirectURL': r_url},
+                           Status={'Code': {'Code': BUCKAROO_790_PENDING_INPUT}})
 
         Pay(transaction=transaction,
             testing=True)._handle_transaction_response(response=res)
@@ -51,6 +58,52 @@ class TestPay:
         assert transaction.status == 'pending'
         assert transaction.redirect_url == r_url
 
+    def test_valid_response_single_transaction_write(self, transaction):
+        res = api_response(status_code=status.HTTP_200_OK,
+                           PaymentKey='pk', Key='tk',
+                           RequiredAction={'RedirectURL': "www.test.com"},
+                           Status={'Code': {'Code': BUCKAROO_790_PENDING_INPUT}})
+
+        with CaptureQueriesContext(connection) as queries:
+            Pay(transaction=transaction,
+                testing=True)._handle_transaction_response(response=res)
+
+        updates = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE') and 'buckaroo_transaction' in q['sql']]
+        assert len(updates) == 1
+
+        transaction.refresh_from_db()
+        assert transaction.status == 'pending'
+        assert transaction.payment_key == 'pk'
+        assert transaction.transaction_key == 'tk'
+        assert transaction.redirect_url == "www.test.com"
+
+    def test_invalid_response_keys_saved(self, transaction):
+        res = api_response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                           PaymentKey='pk', Key='tk')
+
+        with pytest.raises(BuckarooException):
+            Pay(transaction=transaction,
+                testing=True)._handle_transaction_response(response=res)
+
+        transaction.refresh_from_db()
+        assert transaction.status == 'new'
+        assert transaction.payment_key == 'pk'
+        assert transaction.transaction_key == 'tk'
+
+    def test_error_response_without_keys(self, transaction):
+        res = BuckarooResponse(status_code=status.HTTP_401_UNAUTHORIZED,
+                               data={'Message': 'Authorization failed'})
+
+        with pytest.raises(BuckarooException) as err:
+            Pay(transaction=transaction,
+                testing=True)._handle_transaction_response(response=res)
+
+        assert err.value.args[0]['status'] == status.HTTP_401_UNAUTHORIZED
+        transaction.refresh_from_db()
+        assert transaction.status == 'new'
+        assert transaction.payment_key is None
+
 
 @pytest.mark.django_db(transaction=False)
 class TestRefund:
@@ -90,15 +143,15 @@ class TestRefund:
                  status.HTTP_500_INTERNAL_SERVER_ERROR]
 
         for code in codes:
-            res = Response(status_code=code)
+            res = api_response(status_code=code)
             with pytest.raises(BuckarooException) as err:
                 Refund(transaction=transaction,
                        testing=True)._handle_transaction_response(response=res)
             assert err.value.args[0]['status'] == code
 
     def test_handle_response_invalid_buckaroo_status(self, transaction):
-        res = Response(status_code=status.HTTP_200_OK,
-                       Status={'Code': {'Code': status.HTTP_500_INTERNAL_SERVER_ERROR}})
+        res = api_response(status_code=status.HTTP_200_OK,
+                           Status={'Code': {'Code': status.HTTP_500_INTERNAL_SERVER_ERROR}})
 
         assert transaction.refunded is False
 
@@ -112,8 +165,8 @@ class TestRefund:
         assert transaction.refunded is False
 
     def test_successful_refund(self, transaction):
-        res = Response(status_code=status.HTTP_200_OK,
-                       Status={'Code': {'Code': BUCKAROO_190_SUCCESS}})
+        res = api_response(status_code=status.HTTP_200_OK,
+                           Status={'Code': {'Code': BUCKAROO_190_SUCCESS}})
 
         assert transaction.refunded is False
 
@@ -123,8 +176,8 @@ class TestRefund:
         assert transaction.refunded is True
 
     def test_handle_transaction_response_send_raw_res(self, transaction):
-        res = Response(status_code=status.HTTP_200_OK,
-                       Status={'Code': {'Code': BUCKAROO_190_SUCCESS}})
+        res = api_response(status_code=status.HTTP_200_OK,
+                           Status={'Code': {'Code': BUCKAROO_190_SUCCESS}})
 
         assert transaction.refunded is False
 
@@ -0,0 +1,67 @@
+import pytest
+
+from actstream.models import Action
+
+from .. import tasks
+from ..activity import (activity_batch, close_activity_batch, drain_activity,
+                        open_activity_batch, write_activity_records)
+
+
+@pytest.fixture
+def outbox_settings(settings):
+    settings.BUCKAROO_ACTIVITY_OUTBOX = True
+    return settings
+
+
+# The outbox only receives records on commit, so the data is committed.
+@pytest.mark.django_db(transaction=True)
+class TestActivityOutbox:
+    def test_direct_by_default(self, transaction):
+        count = Action.objects.count()
+
+        transaction.pending()
+
+        assert Action.objects.count() == count + 1
+        assert drain_activity() == []
+
+    def test_direct_outside_batch(self, outbox_settings, transaction):
+        count = Action.objects.count()
+
+        transaction.pending()
+
+        assert Action.objects.count() == count + 1
+        assert drain_activity() == []
+
+    def test_buffered(self, outbox_settings, transaction_pending):
+        count = Action.objects.count()
+
+        open_activity_batch()
+        try:
+            transaction_pending.success()
+            assert Action.objects.count() == count
+
+            records = drain_activity()
+        finally:
+            close_activity_batch()
+
+        assert [r['verb'] for r in records] == ['completed']
+        assert drain_activity() == []
+
+        write_activity_records(records)
+
+        action = Action.objects.latest('timestamp')
+        assert Action.objects.count() == count + 1
+        assert action.verb == 'completed'
+        assert action.actor == transaction_pending
+
+    def test_batch_flushes_on_close(self, outbox_settings, transaction_pending, monkeypatch):
+        queued = []
+        monkeypatch.setattr(tasks, 'write_activity', queued.extend)
+
+        with activity_batch():
+            with activity_batch():
+                transaction_pending.success()
+            assert queued == []
+
+        assert [r['verb'] for r in queued] == ['completed']
+        assert drain_activity() == []
@@ -0,0 +1,92 @@
+import asyncio
+import gc
+import pytest
+from rest_framework import status
+
+from .. import aio
+from ..aio import AsyncPay, AsyncRefund
+from ..models import BUCKAROO_790_PENDING_INPUT, BUCKAROO_190_SUCCESS
+from ..utils import BuckarooResponse
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def async_api(monkeypatch):
+    calls = []
+    responses = []
+
+    async def fake_api_call(transaction, url, method, data=None):
+        calls.append((url, method, data))
+        return responses.pop(0)
+
+    monkeypatch.setattr(aio, 'async_buckaroo_api_call', fake_api_call)
+    return calls, responses
+
+
+# The database work runs on executor threads with their own connections,
+# so the test data has to be committed.
+@pytest.mark.django_db(transaction=True)
+class TestAsyncPay:
+    def test_async_pay(self, ideal_transaction, buckaroo_settings, async_api):
+        buckaroo_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+
+        calls, responses = async_api
+        responses.append(BuckarooResponse(
+            status_code=status.HTTP_200_OK,
+            data=dict(PaymentKey='pk', Key='tk',
+                      RequiredAction={'RedirectURL': 'www.test.com'},
+                      Status={'Code': {'Code': BUCKAROO_790_PENDING_INPUT}})))
+
+        run(AsyncPay(transaction=ideal_transaction, testing=True).async_pay())
+
+        assert calls[0][1] == 'POST'
+        assert ideal_transaction.status == 'pending'
+        assert ideal_transaction.redirect_url == 'www.test.com'
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAsyncRefund:
+    def test_async_refund(self, ideal_transaction, buckaroo_settings, async_api):
+        buckaroo_settings.BUCKAROO_REFUND_FEE = 0
+        buckaroo_settings.BUCKAROO_DISABLE_REFUND = False
+        buckaroo_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+
+        calls, responses = async_api
+        responses.append(BuckarooResponse(
+            status_code=status.HTTP_200_OK,
+            data=dict(IsRefundable=True, MaximumRefundAmount=100,
+                      AllowPartialRefund=True, RefundedAmount=0)))
+        responses.append(BuckarooResponse(
+            status_code=status.HTTP_200_OK,
+            data=dict(Status={'Code': {'Code': BUCKAROO_190_SUCCESS}})))
+
+        run(AsyncRefund(transaction=ideal_transaction, amount=25,
+                        testing=True).async_refund())
+
+        assert [c[1] for c in calls] == ['GET', 'POST']
+        assert ideal_transaction.refunded is True
+
+
+class TestAsyncClients:
+    def test_client_per_loop_is_released(self):
+        pytest.importorskip('aiohttp')
+
+        async def get_client():
+            return id(aio.get_async_client())
+
+        loop = asyncio.new_event_loop()
+        client_id = loop.run_until_complete(get_client())
+        assert client_id == id(aio._clients[loop])
+
+        loop.close()
+        del loop
+        gc.collect()
+
+        assert client_id not in [id(client) for client in aio._clients.values()]
@@ -1,9 +1,15 @@
+from unittest import mock
+
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
 
 from order.tests.factories import OrderFactory
 from utils.tests.factories import UserFactory
+from ..models import Transaction
+from ..dedup import PushDeduplicator
+from ..views import TransactionList
 from .factories import TransactionFactory
 
 
@@ -88,6 +94,60 @@ class TransactionAPITestCase(APITestCase):
         assert response.data[0] == 'Incorrect order status: new'
 
 
+class TransactionIdempotencyTestCase(APITestCase):
+    """Repeated payment requests return the pending transaction."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory.create()
+        self.client.force_login(self.user)
+        self.order = OrderFactory.create(total=100, owner=self.user, state='pending')
+        self.transaction = TransactionFactory.create(order=self.order,
+                                                     status='pending',
+                                                     payment_method='ideal',
+                                                     bank_code='ABNANL2A',
+                                                     redirect_url='www.test.com')
+        self.data = dict(bank_code='ABNANL2A',
+                         order=self.order.id,
+                         payment_method='ideal')
+
+    def test_repeated_request(self):
+        response = self.client.post(reverse('buckaroo_transaction_list'),
+                                    self.data,
+                                    format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['id'] == self.transaction.id
+        assert response.data['redirect_url'] == 'www.test.com'
+        assert Transaction.objects.filter(order=self.order).count() == 1
+
+    def test_idempotency_key_from_cache(self):
+        view = TransactionList()
+        view.request = mock.Mock(META={'HTTP_IDEMPOTENCY_KEY': 'abc'})
+        cache.set(view.get_idempotency_key(dict(order=self.order)), self.transaction.id)
+
+        response = self.client.post(reverse('buckaroo_transaction_list'),
+                                    self.data,
+                                    format='json',
+                                    HTTP_IDEMPOTENCY_KEY='abc')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['id'] == self.transaction.id
+
+    def test_payment_in_progress(self):
+        view = TransactionList()
+        view.request = mock.Mock(META={'HTTP_IDEMPOTENCY_KEY': 'abc'})
+        cache.add(view.get_idempotency_key(dict(order=self.order)) + ':lock', True)
+
+        response = self.client.post(reverse('buckaroo_transaction_list'),
+                                    self.data,
+                                    format='json',
+                                    HTTP_IDEMPOTENCY_KEY='abc')
+
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert Transaction.objects.filter(order=self.order).count() == 1
+
+
 class TransactionPushAPITestCase(APITestCase):
     """Tests for the Transaction Push endpoint."""
 
@@ -137,3 +197,120 @@ class TransactionPushAPITestCase(APITestCase):
 
         assert response.status_code == status.HTTP_200_OK
         assert response.data == 'ok'
+
+
+class TransactionPushQueueTestCase(APITestCase):
+    """Pushes are acknowledged immediately and handed to a huey task."""
+
+    def setUp(self):
+        self.queued = []
+        for patcher in (mock.patch('buckaroo.views.process_push',
+                                   side_effect=self.queued.append),
+                        mock.patch('buckaroo.views.push_deduplicator', PushDeduplicator())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_push_is_queued(self):
+        data = {"Transaction": {"PaymentKey": "ABC", "Status": {"Code": {"Code": 190}}}}
+        response = self.client.post(reverse('buckaroo_push'),
+                                    data=data,
+                                    HTTP_HOST="buckaroo.com",
+                                    format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == 'ok'
+        assert self.queued == [data['Transaction']]
+
+    def test_push_without_payment_key(self):
+        response = self.client.post(reverse('buckaroo_push'),
+                                    data={"Transaction": {"Status": {}}},
+                                    HTTP_HOST="buckaroo.com",
+                                    format='json')
+
+        assert response.data == 'Transaction not found'
+        assert self.queued == []
+
+    def test_repeated_push_is_queued_once(self):
+        data = {"Transaction": {"PaymentKey": "ABC",
+                                "Status": {"Code": {"Code": 190},
+                                           "DateTime": "2017-01-01T12:00:00"}}}
+        for _ in range(2):
+            response = self.client.post(reverse('buckaroo_push'),
+                                        data=data,
+                                        HTTP_HOST="buckaroo.com",
+                                        format='json')
+            assert response.data == 'ok'
+
+        assert self.queued == [data['Transaction']]
+
+
+class TransactionListingTestCase(APITestCase):
+    """Tests for the cursor paginated transaction listing."""
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.client.force_login(self.user)
+        self.order = OrderFactory.create(total=100, owner=self.user, state='pending')
+        self.transactions = [TransactionFactory.create(order=self.order, payment_method='ideal')
+                             for i in range(3)]
+
+    def get(self, **params):
+        return self.client.get(reverse('buckaroo_transactions'), params, format='json')
+
+    def ids(self, response):
+        return [t['id'] for t in response.data['results']]
+
+    def test_newest_first(self):
+        response = self.get()
+
+        assert response.status_code == status.HTTP_200_OK
+        assert self.ids(response) == [t.id for t in reversed(self.transactions)]
+
+    def test_cursor_pages(self):
+        first = self.get(page_size=2)
+        assert self.ids(first) == [self.transactions[2].id, self.transactions[1].id]
+
+        second = self.client.get(first.data['next'], format='json')
+        assert self.ids(second) == [self.transactions[0].id]
+        assert second.data['next'] is None
+
+    def test_page_size_setting(self):
+        with self.settings(BUCKAROO_TRANSACTION_PAGE_SIZE=1):
+            response = self.get()
+
+        assert self.ids(response) == [self.transactions[2].id]
+
+    def test_owner_only(self):
+        TransactionFactory.create()
+        assert len(self.get().data['results']) == 3
+
+    def test_anonymous(self):
+        self.client.logout()
+        assert self.get().status_code == status.HTTP_403_FORBIDDEN
+
+    def test_filters(self):
+        other = TransactionFactory.create(order=self.order, payment_method='creditcard')
+
+        assert self.ids(self.get(payment_method='creditcard')) == [other.id]
+        assert self.ids(self.get(status='pending')) == []
+        assert len(self.get(order=self.order.id).data['results']) == 4
+        assert self.ids(self.get(created_before='2000-01-01')) == []
+        assert len(self.get(created_after='2000-01-01T00:00:00').data['results']) == 4
+
+    def test_invalid_filter(self):
+        assert self.get(created_after='yesterday').status_code == status.HTTP_400_BAD_REQUEST
+        assert self.get(order='abc').status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_etag(self):
+        response = self.get()
+        etag = response['ETag']
+
+        not_modified = self.client.get(reverse('buckaroo_transactions'), format='json',
+                                       HTTP_IF_NONE_MATCH=etag)
+        assert not_modified.status_code == status.HTTP_304_NOT_MODIFIED
+
+        TransactionFactory.create(order=self.order)
+        changed = self.client.get(reverse('buckaroo_transactions'), format='json',
+                                  HTTP_IF_NONE_MATCH=etag)
+        assert changed.status_code == status.HTTP_200_OK
+        assert changed['ETag'] != etag
@@ -0,0 +1,44 @@
+import os
+
+from .. import client as client_module
+from ..client import BuckarooClient, get_client, reset_client
+
+
+class TestClient:
+    def setup_method(self, method):
+        reset_client()
+
+    def teardown_method(self, method):
+        reset_client()
+
+    def test_get_client_is_shared(self):
+        assert get_client() is get_client()
+
+    def test_reset_client(self):
+        client = get_client()
+        reset_client()
+        assert get_client() is not client
+
+    def test_new_client_after_fork(self, monkeypatch):
+        client = get_client()
+        child_pid = os.getpid() + 1
+
+        # As seen from a forked worker.
+        monkeypatch.setattr(client_module.os, 'getpid', lambda: child_pid)
+
+        assert get_client() is not client
+        assert get_client() is get_client()
+
+    def test_pool_settings(self, settings):
+        settings.BUCKAROO_POOL_CONNECTIONS = 2
+        settings.BUCKAROO_POOL_MAXSIZE = 8
+
+        client = get_client()
+
+        assert client.pool_connections == 2
+        assert client.pool_maxsize == 8
+
+    def test_adapter_mounted(self):
+        client = BuckarooClient(pool_connections=1, pool_maxsize=3)
+        adapter = client.session.get_adapter('https://checkout.buckaroo.nl/')
+        assert adapter._pool_maxsize == 3
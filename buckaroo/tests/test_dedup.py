@@ -0,0 +1,82 @@
+import pytest
+
+from datetime import timedelta
+
+from django.utils import timezone
+
+from ..dedup import PushDeduplicator, get_push_key, prune_push_receipts
+from ..models import PushReceipt
+
+
+def push(payment_key='ABC', code=190, timestamp='2017-01-01T12:00:00'):
+    return dict(PaymentKey=payment_key,
+                Status=dict(Code=dict(Code=code), DateTime=timestamp))
+
+
+class TestGetPushKey:
+    def test_key(self):
+        assert get_push_key(push()) == ('ABC', 190, '2017-01-01T12:00:00')
+
+    def test_incomplete_push(self):
+        assert get_push_key(dict(PaymentKey='ABC', Status=dict(Code=dict(Code=190)))) is None
+        assert get_push_key(dict(PaymentKey='ABC', Status=None)) is None
+
+
+@pytest.mark.django_db
+class TestPushDeduplicator:
+    def test_first_push_is_recorded(self):
+        assert not PushDeduplicator().is_duplicate(get_push_key(push()))
+        assert PushReceipt.objects.count() == 1
+
+    def test_repeated_push(self):
+        dedup = PushDeduplicator()
+        key = get_push_key(push())
+
+        assert not dedup.is_duplicate(key)
+        assert dedup.is_duplicate(key)
+        assert PushReceipt.objects.count() == 1
+
+    def test_other_status_or_time_is_new(self):
+        dedup = PushDeduplicator()
+
+        assert not dedup.is_duplicate(get_push_key(push()))
+        assert not dedup.is_duplicate(get_push_key(push(code=791)))
+        assert not dedup.is_duplicate(get_push_key(push(timestamp='2017-01-01T12:00:01')))
+
+    def test_seen_by_other_process(self):
+        key = get_push_key(push())
+        PushDeduplicator().is_duplicate(key)
+
+        # A fresh cache falls back on the receipts table.
+        assert PushDeduplicator().is_duplicate(key)
+
+    def test_cache_is_bounded(self):
+        dedup = PushDeduplicator(maxsize=2)
+        for payment_key in ('A', 'B', 'C'):
+            dedup.is_duplicate(get_push_key(push(payment_key=payment_key)))
+
+        assert list(dedup._keys) == [('B', 190, '2017-01-01T12:00:00'),
+                                     ('C', 190, '2017-01-01T12:00:00')]
+
+    def test_forget(self):
+        dedup = PushDeduplicator()
+        key = get_push_key(push())
+        dedup.is_duplicate(key)
+
+        dedup.forget(key)
+
+        assert not PushReceipt.objects.exists()
+        assert not dedup.is_duplicate(key)
+
+
+@pytest.mark.django_db
+class TestPrunePushReceipts:
+    def test_prune_old_receipts(self):
+        dedup = PushDeduplicator()
+        dedup.is_duplicate(get_push_key(push(payment_key='OLD')))
+        dedup.is_duplicate(get_push_key(push(payment_key='NEW')))
+        PushReceipt.objects.filter(payment_key='OLD').update(
+            received=timezone.now() - timedelta(days=31))
+
+        assert prune_push_receipts(days=30) == 1
+        assert list(PushReceipt.objects.values_list('payment_key', flat=True)) == ['NEW']
@@ -0,0 +1,103 @@
+import json
+import logging
+
+from django.http import QueryDict
+
+from ..log import LogEvent, Payload, redact, REDACTED, NOT_SAMPLED
+
+
+class Rendered:
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'rendered'
+
+
+class TestRedact:
+    def test_card_and_consumer_fields(self):
+        data = {'Invoice': '1',
+                'cardname': 'visa',
+                'BRQ_SERVICE_IDEAL_CONSUMERIBAN': 'NL44RABO0123456789',
+                'Services': {'ServiceList': [{'Name': 'ideal',
+                                              'Parameters': [{'Name': 'issuer',
+                                                              'Value': 'ABNANL2A'}]}]},
+                'CustomerName': 'J. de Tester'}
+
+        assert redact(data) == {'Invoice': '1',
+                                'cardname': REDACTED,
+                                'BRQ_SERVICE_IDEAL_CONSUMERIBAN': REDACTED,
+                                # The issuer is not about the consumer.
+                                'Services': data['Services'],
+                                'CustomerName': REDACTED}
+
+    def test_service_parameters(self):
+        push = {'Key': 'ABC',
+                'Status': {'Code': {'Code': 190}},
+                'Services': [{'Name': 'ideal',
+                              'Action': None,
+                              'Parameters': [{'Name': 'consumerIssuer', 'Value': 'ABN AMRO'},
+                                             {'Name': 'transactionId',
+                                              'Value': '0000000000000001'},
+                                             {'Name': 'consumerName', 'Value': 'J. de Tester'},
+                                             {'Name': 'consumerIBAN',
+                                              'Value': 'NL44RABO0123456789'},
+                                             {'Name': 'consumerBIC', 'Value': 'RABONL2U'}]},
+                             {'Name': 'mastercard',
+                              'Action': None,
+                              'Parameters': [{'Name': 'CardNumberEnding', 'Value': '0004'}]}]}
+
+        assert redact(push) == {
+            'Key': 'ABC',
+            'Status': {'Code': {'Code': 190}},
+            'Services': [{'Name': 'ideal',
+                          'Action': None,
+                          'Parameters': [{'Name': 'consumerIssuer', 'Value': REDACTED},
+                                         {'Name': 'transactionId',
+                                          'Value': '0000000000000001'},
+                                         {'Name': 'consumerName', 'Value': REDACTED},
+                                         {'Name': 'consumerIBAN', 'Value': REDACTED},
+                                         {'Name': 'consumerBIC', 'Value': REDACTED}]},
+                         {'Name': 'mastercard',
+                          'Action': None,
+                          'Parameters': [{'Name': 'CardNumberEnding', 'Value': REDACTED}]}]}
+
+    def test_configured_keys(self, settings):
+        settings.BUCKAROO_LOG_REDACTED_KEYS = ['invoice']
+        assert redact({'Invoice': '1', 'card': 'visa'}) == {'Invoice': REDACTED,
+                                                            'card': 'visa'}
+
+
+class TestPayload:
+    def test_rendered_redacted(self):
+        assert json.loads(str(Payload({'card': 'visa', 'Key': 'ABC'}))) == \
+            {'card': REDACTED, 'Key': 'ABC'}
+
+    def test_querydict(self):
+        data = QueryDict('BRQ_CUSTOMER_NAME=Tester&BRQ_STATUSCODE=190')
+        assert json.loads(str(Payload(data))) == {'BRQ_CUSTOMER_NAME': REDACTED,
+                                                  'BRQ_STATUSCODE': '190'}
+
+    def test_sampling(self, settings):
+        settings.BUCKAROO_LOG_PAYLOAD_SAMPLE_RATE = 0
+        assert str(Payload({'Key': 'ABC'})) == NOT_SAMPLED
+
+
+class TestLogEvent:
+    def test_render(self):
+        event = LogEvent("API response", transaction=1, status_code=200)
+        assert str(event) == "API response status_code=200 transaction=1"
+
+    def test_lazy(self):
+        logger = logging.getLogger('buckaroo.tests.lazy')
+        logger.setLevel(logging.WARNING)
+        field = Rendered()
+
+        logger.info(LogEvent("API response", data=field))
+        assert field.count == 0
+
+        event = LogEvent("API response", data=field)
+        str(event)
+        str(event)
+        assert field.count == 1
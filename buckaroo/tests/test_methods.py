@@ -0,0 +1,91 @@
+import pytest
+
+from ..actions import Pay
+from ..exceptions import BuckarooException
+from ..methods import (PaymentMethod, Ideal, Creditcard, register, get_payment_method,
+                       load_payment_methods, _registry)
+from ..utils import add_service_json, verify_transaction_fields
+
+
+class Paypal(PaymentMethod):
+    name = 'paypal'
+
+    def validate(self, transaction):
+        if not transaction.card:
+            raise BuckarooException({"message": "Required field missing", "field": "card"})
+
+    def add_service_json(self, body, transaction, action):
+        return add_service_json(body, {'Name': 'paypal', 'Action': action})
+
+
+@pytest.fixture
+def paypal():
+    yield register(Paypal)
+    _registry.pop('paypal', None)
+
+
+class TestRegistry:
+    def test_builtin_methods(self):
+        assert isinstance(get_payment_method('ideal'), Ideal)
+        assert isinstance(get_payment_method('creditcard'), Creditcard)
+        assert get_payment_method('bitcoin') is None
+
+    def test_register(self, paypal):
+        assert get_payment_method('paypal') is paypal
+
+    def test_add_service_json_is_abstract(self):
+        class Incomplete(PaymentMethod):
+            name = 'incomplete'
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def test_register_without_name(self):
+        with pytest.raises(BuckarooException):
+            register(PaymentMethod)
+
+    def test_load_from_settings(self, settings):
+        settings.BUCKAROO_PAYMENT_METHODS = ['buckaroo.tests.test_methods.Paypal']
+        try:
+            load_payment_methods()
+            assert isinstance(get_payment_method('paypal'), Paypal)
+        finally:
+            _registry.pop('paypal', None)
+
+
+@pytest.mark.django_db(transaction=False)
+class TestDispatch:
+    def test_pay_json(self, buckaroo_settings, paypal, transaction):
+        transaction.payment_method = 'paypal'
+
+        data = Pay(transaction=transaction)._prepare_pay_json()
+
+        assert data['Services']['ServiceList'] == [{'Name': 'paypal', 'Action': 'pay'}]
+
+    def test_method_validation(self, paypal, transaction):
+        transaction.payment_method = 'paypal'
+        transaction.card = None
+
+        with pytest.raises(BuckarooException) as err:
+            verify_transaction_fields(transaction)
+        assert err.value.args[0]['field'] == 'card'
+
+
+@pytest.mark.django_db(transaction=False)
+class TestValidation:
+    def test_ideal_unknown_issuer(self, buckaroo_settings, ideal_transaction):
+        buckaroo_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+        get_payment_method('ideal').validate(ideal_transaction)
+
+        ideal_transaction.bank_code = 'blabla'
+        with pytest.raises(BuckarooException) as err:
+            get_payment_method('ideal').validate(ideal_transaction)
+        assert err.value.args[0]['field'] == 'bank_code'
+
+    def test_creditcard_unknown_card(self, cc_transaction):
+        get_payment_method('creditcard').validate(cc_transaction)
+
+        cc_transaction.card = 'amex'
+        with pytest.raises(BuckarooException) as err:
+            get_payment_method('creditcard').validate(cc_transaction)
+        assert err.value.args[0]['field'] == 'card'
@@ -0,0 +1,134 @@
+import pytest
+import urllib.request
+
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from ..client import BuckarooClient
+from ..exceptions import BuckarooException
+from ..metrics import (Registry, Counter, Gauge, Histogram, get_endpoint, record_status,
+                       status_codes, transitions_not_allowed, api_errors, api_request_duration,
+                       start_exporter, CONTENT_TYPE)
+from ..resilience import get_circuit_breaker, reset_circuit_breaker
+from ..models import BUCKAROO_190_SUCCESS
+from ..utils import BuckarooResponse
+from .factories import TransactionFactory
+
+
+class TestRegistry:
+    def test_counter(self):
+        registry = Registry()
+        counter = Counter('calls_total', "Calls.", ('method',), registry=registry)
+        counter.inc(method='GET')
+        counter.inc(2, method='GET')
+
+        assert counter.get(method='GET') == 3
+        assert registry.generate_text() == ('# HELP calls_total Calls.\n'
+                                            '# TYPE calls_total counter\n'
+                                            'calls_total{method="GET"} 3.0\n')
+
+    def test_wrong_labels(self):
+        with pytest.raises(ValueError):
+            Counter('calls_total', "Calls.", ('method',)).inc(endpoint='Transaction')
+
+    def test_gauge(self):
+        gauge = Gauge('in_flight', "In flight.")
+        with gauge.track_inprogress():
+            assert gauge.get() == 1
+        assert gauge.get() == 0
+
+        gauge.set_function(lambda: 7)
+        assert gauge.samples() == [('in_flight', (), 7)]
+
+    def test_histogram(self):
+        histogram = Histogram('duration_seconds', "Duration.", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        assert histogram.get() == (3, pytest.approx(5.55))
+        assert [(name, labels, value) for name, labels, value in histogram.samples()
+                if name.endswith('_bucket')] == [
+            ('duration_seconds_bucket', (('le', '0.1'),), 1),
+            ('duration_seconds_bucket', (('le', '1.0'),), 2),
+            ('duration_seconds_bucket', (('le', '+Inf'),), 3)]
+
+
+class TestInstrumentation:
+    def test_endpoint(self):
+        assert get_endpoint('https://checkout.buckaroo.nl/json/Transaction/') == 'Transaction'
+        assert get_endpoint('https://checkout.buckaroo.nl/json/Transaction/RefundInfo/ABC') == \
+            'Transaction/RefundInfo'
+        assert get_endpoint('https://checkout.buckaroo.nl/json/Transaction/Status/ABC') == \
+            'Transaction/Status'
+
+    def test_record_status(self):
+        before = status_codes.get(code=BUCKAROO_190_SUCCESS, source='api')
+
+        record_status(BuckarooResponse(200, {'Status': {'Code': {'Code': 190}}}))
+        record_status(BuckarooResponse(200, {}))
+
+        assert status_codes.get(code=BUCKAROO_190_SUCCESS, source='api') == before + 1
+
+    @pytest.mark.django_db(transaction=False)
+    def test_transition_not_allowed(self):
+        transaction = TransactionFactory.create(order__state='pending')
+        before = transitions_not_allowed.get(target=transaction.STATUS_SUCCESS)
+
+        assert transaction.apply_status_code(BUCKAROO_190_SUCCESS) is None
+        assert transitions_not_allowed.get(target=transaction.STATUS_SUCCESS) == before + 1
+
+    def test_rejected_call_not_counted(self, settings):
+        settings.BUCKAROO_CIRCUIT_FAILURES = 1
+        reset_circuit_breaker()
+        url = 'https://checkout.buckaroo.nl/json/Transaction/Status/ABC'
+        errors = api_errors.get(endpoint='Transaction/Status', method='GET')
+        calls = api_request_duration.get(endpoint='Transaction/Status', method='GET')
+
+        try:
+            get_circuit_breaker().record_failure()
+            with pytest.raises(BuckarooException):
+                BuckarooClient().get(url)
+        finally:
+            reset_circuit_breaker()
+
+        assert api_errors.get(endpoint='Transaction/Status', method='GET') == errors
+        assert api_request_duration.get(endpoint='Transaction/Status', method='GET') == calls
+
+    def test_exporter(self):
+        server = start_exporter(0)
+        try:
+            url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                body = response.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert b'# TYPE buckaroo_push_processing_seconds histogram' in body
+        assert b'# TYPE buckaroo_api_request_duration_seconds histogram' in body
+
+
+class MetricsViewTestCase(APITestCase):
+    @override_settings(BUCKAROO_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_allowed_scraper(self):
+        response = self.client.get(reverse('buckaroo_metrics'))
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == CONTENT_TYPE
+        assert b'# TYPE buckaroo_api_request_duration_seconds histogram' in response.content
+        # Recorded by the huey consumer, not served here.
+        assert b'buckaroo_push_processing_seconds' not in response.content
+
+    def test_no_addresses_by_default(self):
+        response = self.client.get(reverse('buckaroo_metrics'))
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    @override_settings(BUCKAROO_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_other_address(self):
+        response = self.client.get(reverse('buckaroo_metrics'), REMOTE_ADDR='10.0.0.1')
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
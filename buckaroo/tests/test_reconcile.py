@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+import pytest
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..models import Transaction, BUCKAROO_490_FAILED, BUCKAROO_791_PENDING_PROCESSING
+from ..reconcile import Reconcile
+from .factories import TransactionFactory
+
+
+def stuck_transaction(key, minutes=120, **kwargs):
+    transaction = TransactionFactory.create(status='pending', transaction_key=key,
+                                            order__state='pending', **kwargs)
+    Transaction.objects.filter(pk=transaction.pk).update(
+        created=timezone.now() - timedelta(minutes=minutes))
+    return transaction
+
+
+# Statuses are fetched on worker threads with their own database
+# connections, so the test data has to be committed.
+@pytest.mark.django_db(transaction=True)
+class TestReconcile:
+    def test_applies_status(self, buckaroo_server):
+        success = stuck_transaction('SUCCESS')
+        failed = stuck_transaction('FAILED')
+        waiting = stuck_transaction('WAITING')
+        buckaroo_server.set_status('FAILED', BUCKAROO_490_FAILED)
+        buckaroo_server.set_status('WAITING', BUCKAROO_791_PENDING_PROCESSING)
+
+        report = Reconcile(workers=2, rate=None, chunk_size=2).run()
+
+        assert sorted(report.updated) == sorted([(success.id, Transaction.STATUS_SUCCESS),
+                                                 (failed.id, Transaction.STATUS_FAILED)])
+        assert report.unchanged == [waiting.id]
+        assert Transaction.objects.get(pk=success.pk).status == Transaction.STATUS_SUCCESS
+        assert Transaction.objects.get(pk=failed.pk).status == Transaction.STATUS_FAILED
+        assert Transaction.objects.get(pk=waiting.pk).status == Transaction.STATUS_PENDING
+
+    def test_skips_recent_and_settled(self, buckaroo_server):
+        stuck_transaction('RECENT', minutes=5)
+        TransactionFactory.create(status='success', transaction_key='DONE')
+
+        report = Reconcile(workers=1, rate=None, older_than=60).run()
+
+        assert report.processed == 0
+        assert buckaroo_server.requests == 0
+
+    def test_dry_run(self, buckaroo_server):
+        transaction = stuck_transaction('SUCCESS')
+
+        report = Reconcile(workers=1, rate=None, dry_run=True).run()
+
+        assert report.updated == [(transaction.id, Transaction.STATUS_SUCCESS)]
+        assert Transaction.objects.get(pk=transaction.pk).status == Transaction.STATUS_PENDING
+
+    def test_no_deferred_loads(self, buckaroo_server):
+        stuck_transaction('SUCCESS')
+        reconcile = Reconcile(workers=1, rate=None)
+        transaction = next(reconcile._chunks())[0]
+
+        # No deferred fields are loaded on the way.
+        with CaptureQueriesContext(connection) as queries:
+            reconcile.get_status(transaction)
+
+        assert queries.captured_queries == []
+
+    def test_api_error(self, buckaroo_server):
+        transaction = stuck_transaction('ERROR')
+        buckaroo_server.http_status = 400
+
+        report = Reconcile(workers=1, rate=None).run()
+
+        assert [t_id for t_id, err in report.failed] == [transaction.id]
+
+    def test_command(self, buckaroo_server, capsys):
+        transaction = stuck_transaction('SUCCESS')
+
+        call_command('reconcile_transactions', '--dry-run', '--workers=1')
+
+        assert "{0}: success".format(transaction.id) in capsys.readouterr().out
+        assert Transaction.objects.get(pk=transaction.pk).status == Transaction.STATUS_PENDING
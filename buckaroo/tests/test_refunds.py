@@ -0,0 +1,102 @@
+import pytest
+
+from decimal import Decimal
+
+from ..actions import Refund
+from ..exceptions import BuckarooException
+from ..models import Transaction, BUCKAROO_190_SUCCESS, BUCKAROO_793_ON_HOLD
+from ..refunds import BulkRefund
+from ..utils import RateLimiter
+from .factories import TransactionFactory
+
+
+@pytest.fixture
+def refund_settings(buckaroo_settings):
+    buckaroo_settings.BUCKAROO_REFUND_FEE = 0
+    buckaroo_settings.BUCKAROO_DISABLE_REFUND = False
+    buckaroo_settings.BUCKAROO_TEST_MODE = True
+    return buckaroo_settings
+
+
+# Refunds run on worker threads with their own database connections,
+# so the test data has to be committed.
+@pytest.mark.django_db(transaction=True)
+class TestBulkRefund:
+    def test_report(self, refund_settings, monkeypatch):
+        refunded = TransactionFactory.create(status='success', order__total=10)
+        on_hold = TransactionFactory.create(status='success', order__total=10)
+        failed = TransactionFactory.create(status='success', order__total=10)
+
+        def fake_refund(self):
+            if self.transaction.id == failed.id:
+                raise BuckarooException({"message": 'Ticket price too high'})
+            if self.transaction.id == on_hold.id:
+                self.b_status_code = BUCKAROO_793_ON_HOLD
+            else:
+                self.b_status_code = BUCKAROO_190_SUCCESS
+            self.transaction.refunded = True
+            self.transaction.save()
+
+        monkeypatch.setattr(Refund, 'refund', fake_refund)
+
+        report = BulkRefund(queryset=Transaction.objects.all(), workers=1,
+                            rate=None, chunk_size=2).run()
+
+        assert report.refunded == [refunded.id]
+        assert report.on_hold == [on_hold.id]
+        assert [t_id for t_id, err in report.failed] == [failed.id]
+
+    def test_skips_refunded(self, refund_settings, monkeypatch):
+        TransactionFactory.create(status='success', refunded=True)
+        calls = []
+
+        monkeypatch.setattr(Refund, 'refund', lambda self: calls.append(self))
+
+        report = BulkRefund(queryset=Transaction.objects.all(), workers=1, rate=None).run()
+
+        assert calls == []
+        assert report.processed == 0
+
+    def test_fixed_amount(self, refund_settings, monkeypatch):
+        TransactionFactory.create(status='success', order__total=10)
+        amounts = []
+
+        monkeypatch.setattr(Refund, 'refund', lambda self: amounts.append(self.amount))
+
+        BulkRefund(queryset=Transaction.objects.all(), get_amount=5, workers=1, rate=None).run()
+
+        assert amounts == [5]
+
+    def test_stand_in_server(self, refund_settings, buckaroo_server):
+        refund_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+        transactions = [TransactionFactory.create(status='success', payment_method='ideal',
+                                                  bank_code='ABNANL2A', order__total=10)
+                        for i in range(3)]
+
+        report = BulkRefund(queryset=Transaction.objects.all(), get_amount=Decimal('7.50'),
+                            workers=2, rate=None).run()
+
+        assert sorted(report.refunded) == sorted(t.id for t in transactions)
+        assert report.failed == []
+        assert Transaction.objects.filter(refunded=True).count() == 3
+        # A RefundInfo GET and a refund POST per transaction.
+        assert buckaroo_server.requests == 6
+        assert buckaroo_server.auth_failures == 0
+
+    def test_refunds_disabled(self, refund_settings):
+        refund_settings.BUCKAROO_DISABLE_REFUND = True
+        TransactionFactory.create(status='success')
+
+        report = BulkRefund(queryset=Transaction.objects.all(), workers=1).run()
+
+        assert report.processed == 0
+
+
+class TestRateLimiter:
+    def test_no_rate(self):
+        limiter = RateLimiter()
+        limiter.wait()
+        assert limiter.interval == 0
+
+    def test_interval(self):
+        assert RateLimiter(rate=4).interval == 0.25
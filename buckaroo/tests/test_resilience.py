@@ -0,0 +1,145 @@
+import pytest
+import requests
+
+from ..client import BuckarooClient
+from ..exceptions import BuckarooException
+from ..resilience import (CircuitBreaker, RetryPolicy, get_circuit_breaker,
+                          reset_circuit_breaker)
+from .server import BuckarooStandIn
+
+
+class TestRetryPolicy:
+    def test_get_retried(self):
+        policy = RetryPolicy(retries=2)
+
+        assert policy.should_retry(0, 'GET', status_code=503)
+        assert policy.should_retry(1, 'GET', exc=requests.exceptions.ReadTimeout())
+        assert not policy.should_retry(2, 'GET', status_code=503)
+        assert not policy.should_retry(0, 'GET', status_code=404)
+
+    def test_post_only_when_not_sent(self):
+        policy = RetryPolicy(retries=2)
+
+        assert not policy.should_retry(0, 'POST', status_code=503)
+        assert not policy.should_retry(0, 'POST', exc=requests.exceptions.ReadTimeout())
+        assert policy.should_retry(0, 'POST', exc=requests.exceptions.ConnectTimeout())
+        assert policy.should_retry(0, 'POST', exc=Exception(), not_sent=True)
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+
+        assert 0 <= policy.delay(0) <= 1
+        assert 0 <= policy.delay(5) <= 3
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+
+        assert breaker.state == breaker.OPEN
+        with pytest.raises(BuckarooException) as err:
+            breaker.before_call()
+        assert err.value.args[0]['message'] == "Buckaroo API unavailable"
+        assert breaker.stats()['rejected'] == 1
+
+    def test_half_open_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+
+        breaker.before_call()
+        assert breaker.state == breaker.HALF_OPEN
+
+        with pytest.raises(BuckarooException):
+            breaker.before_call()
+
+        breaker.record_success()
+        assert breaker.state == breaker.CLOSED
+        assert breaker.failures == 0
+
+    def test_stale_trial_expires(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+        breaker.before_call()
+
+        # The trial never reported back.
+        breaker.trial_started_at -= 60
+
+        breaker.before_call()
+        assert breaker.state == breaker.HALF_OPEN
+        with pytest.raises(BuckarooException):
+            breaker.before_call()
+
+
+class TestClientRetries:
+    def setup_method(self, method):
+        reset_circuit_breaker()
+
+    def teardown_method(self, method):
+        reset_circuit_breaker()
+
+    def test_get_retried_on_server_error(self, settings):
+        settings.BUCKAROO_CIRCUIT_FAILURES = 10
+        client = BuckarooClient(retry_policy=RetryPolicy(retries=2, backoff=0))
+
+        with BuckarooStandIn(error_rate=1, check_auth=False) as server:
+            res = client.get(server.url + 'json/Transaction/RefundInfo/ABC')
+
+        assert res.status_code == 500
+        assert server.requests == 3
+
+    def test_post_not_retried_on_server_error(self, settings):
+        settings.BUCKAROO_CIRCUIT_FAILURES = 10
+        client = BuckarooClient(retry_policy=RetryPolicy(retries=2, backoff=0))
+
+        with BuckarooStandIn(error_rate=1, check_auth=False) as server:
+            res = client.post(server.url + 'json/Transaction/', json={})
+
+        assert res.status_code == 500
+        assert server.requests == 1
+
+    def test_connection_error(self, settings):
+        client = BuckarooClient(retry_policy=RetryPolicy(retries=0))
+
+        with pytest.raises(BuckarooException) as err:
+            client.get('http://127.0.0.1:1/')
+        assert err.value.args[0]['message'] == "Buckaroo API request failed"
+
+    def test_interrupted_call_is_not_a_failure(self, settings, monkeypatch):
+        settings.BUCKAROO_CIRCUIT_FAILURES = 1
+        client = BuckarooClient(retry_policy=RetryPolicy(retries=0))
+
+        def interrupted(*args, **kwargs):
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(client, '_send', interrupted)
+
+        with pytest.raises(KeyboardInterrupt):
+            client.get('http://127.0.0.1:1/')
+
+        assert get_circuit_breaker().state == CircuitBreaker.CLOSED
+        assert get_circuit_breaker().failures == 0
+
+    def test_interrupted_trial_frees_the_slot(self, settings, monkeypatch):
+        settings.BUCKAROO_CIRCUIT_FAILURES = 1
+        client = BuckarooClient(retry_policy=RetryPolicy(retries=0))
+        breaker = get_circuit_breaker()
+        breaker.record_failure()
+        breaker.opened_at -= breaker.reset_timeout
+
+        def interrupted(*args, **kwargs):
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(client, '_send', interrupted)
+
+        with pytest.raises(KeyboardInterrupt):
+            client.get('http://127.0.0.1:1/')
+
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # The next call is let through as the trial.
+        breaker.before_call()
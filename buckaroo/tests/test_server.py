@@ -0,0 +1,51 @@
+import pytest
+from rest_framework import status
+
+from ..actions import Pay, Refund
+from ..exceptions import BuckarooException
+from ..models import BUCKAROO_190_SUCCESS
+from ..utils import verify_buckaroo_signature
+from .server import sign_return_data
+
+
+@pytest.fixture
+def server_settings(buckaroo_server, buckaroo_settings):
+    buckaroo_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+    buckaroo_settings.BUCKAROO_REFUND_FEE = 0
+    buckaroo_settings.BUCKAROO_DISABLE_REFUND = False
+    return buckaroo_settings
+
+
+@pytest.mark.django_db(transaction=False)
+class TestStandInServer:
+    def test_pay(self, server_settings, buckaroo_server, ideal_transaction):
+        Pay(transaction=ideal_transaction, testing=True).pay()
+
+        assert ideal_transaction.status == ideal_transaction.STATUS_PENDING
+        assert ideal_transaction.transaction_key in buckaroo_server.transactions
+        assert ideal_transaction.redirect_url.startswith(buckaroo_server.url)
+        assert buckaroo_server.auth_failures == 0
+
+    def test_refund(self, server_settings, buckaroo_server, ideal_transaction):
+        Pay(transaction=ideal_transaction, testing=True).pay()
+
+        Refund(transaction=ideal_transaction, amount=10, testing=True).refund()
+
+        assert ideal_transaction.refunded
+        assert buckaroo_server.requests == 3
+
+    def test_invalid_signature(self, server_settings, buckaroo_server, ideal_transaction):
+        buckaroo_server.secret_key = 'wrong'
+
+        with pytest.raises(BuckarooException) as err:
+            Pay(transaction=ideal_transaction, testing=True).pay()
+
+        assert err.value.args[0]['status'] == status.HTTP_401_UNAUTHORIZED
+        assert buckaroo_server.auth_failures == 1
+
+    def test_return_signature(self, buckaroo_settings):
+        data = sign_return_data(dict(BRQ_STATUSCODE=BUCKAROO_190_SUCCESS,
+                                     BRQ_TRANSACTIONS='ABC'),
+                                buckaroo_settings.BUCKAROO_SECRET_KEY)
+
+        assert verify_buckaroo_signature(data)
@@ -0,0 +1,22 @@
+import pytest
+
+from ..models import Transaction, BUCKAROO_190_SUCCESS
+from ..tasks import process_push
+from .factories import TransactionFactory
+
+
+@pytest.mark.django_db(transaction=False)
+class TestProcessPush:
+    def test_updates_transaction(self):
+        t = TransactionFactory.create(status='pending', payment_key='ABC',
+                                      order__state='pending')
+
+        process_push.call_local(dict(PaymentKey='ABC',
+                                     Status=dict(Code=dict(Code=BUCKAROO_190_SUCCESS))))
+
+        t = Transaction.objects.get(pk=t.pk)
+        assert t.status == t.STATUS_SUCCESS
+        assert t.last_push is not None
+
+    def test_unknown_payment_key(self):
+        assert process_push.call_local(dict(PaymentKey='UNKNOWN')) is None
@@ -0,0 +1,87 @@
+from contextlib import contextmanager
+
+import pytest
+
+from ..actions import Pay
+from ..models import BUCKAROO_190_SUCCESS
+from ..utils import update_transaction_post
+from ..tracing import span, set_tracer, get_tracer, NoopTracer, NOOP_SPAN, TRANSACTION_UUID
+
+
+class RecordingTracer:
+    def __init__(self):
+        self.spans = []
+        self.depth = 0
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        self.spans.append((self.depth, name, dict(attributes or {})))
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+
+def get_recording_tracer():
+    return RecordingTracer()
+
+
+@pytest.fixture
+def tracer():
+    tracer = RecordingTracer()
+    set_tracer(tracer)
+    yield tracer
+    set_tracer(None)
+
+
+class TestTracer:
+    def test_noop_by_default(self, settings):
+        settings.BUCKAROO_TRACING = False
+        set_tracer(None)
+
+        assert isinstance(get_tracer(), NoopTracer)
+        assert span('pay') is NOOP_SPAN
+
+    def test_from_settings(self, settings):
+        settings.BUCKAROO_TRACING = 'buckaroo.tests.test_tracing.get_recording_tracer'
+        set_tracer(None)
+        try:
+            assert isinstance(get_tracer(), RecordingTracer)
+        finally:
+            set_tracer(None)
+
+    def test_span_attributes(self, tracer):
+        with span('http', method='GET'):
+            pass
+
+        assert tracer.spans == [(0, 'buckaroo.http', {'method': 'GET'})]
+
+
+@pytest.mark.django_db(transaction=False)
+class TestPaySpans:
+    def test_nested_spans(self, tracer, buckaroo_server, buckaroo_settings, ideal_transaction):
+        buckaroo_settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+
+        Pay(transaction=ideal_transaction).pay()
+
+        names = [(depth, name) for depth, name, attributes in tracer.spans]
+        assert names[:2] == [(0, 'buckaroo.pay'), (1, 'buckaroo.build_payload')]
+        assert (1, 'buckaroo.http') in names
+        assert (2, 'buckaroo.sign') in names
+        assert (1, 'buckaroo.parse') in names
+        assert (1, 'buckaroo.fsm_transition') in names
+        assert all(attributes[TRANSACTION_UUID] == str(ideal_transaction.uuid)
+                   for depth, name, attributes in tracer.spans)
+
+
+@pytest.mark.django_db(transaction=False)
+class TestReturnSpans:
+    def test_return_span(self, tracer, transaction_pending):
+        update_transaction_post({'BRQ_TRANSACTIONS': transaction_pending.transaction_key,
+                                 'BRQ_STATUSCODE': str(BUCKAROO_190_SUCCESS)})
+
+        depth, name, attributes = tracer.spans[0]
+        assert (depth, name) == (0, 'buckaroo.return')
+        assert attributes[TRANSACTION_UUID] == str(transaction_pending.uuid)
+        assert (1, 'buckaroo.fsm_transition') in [(d, n) for d, n, a in tracer.spans]
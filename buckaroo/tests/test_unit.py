@@ -2,7 +2,10 @@ import pytest
 import hashlib
 import urllib.parse
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 
 from buckaroo.views import update_transaction
@@ -15,27 +18,6 @@ from .factories import TransactionFactory
 from buckaroo.utils import update_transaction_post
 
 
-class Response:
-
-    def __init__(self,
-                 status_code=None,
-                 PaymentKey=1235,
-                 Key=54321,
-                 Status=None,
-                 RequiredAction=None):
-        self.status_code = status_code
-        self.PaymentKey = PaymentKey
-        self.Key = Key
-        self.Status = Status
-        self.RequiredAction = RequiredAction
-
-    def json(self):
-        return self
-
-    def __getitem__(self, item):
-        return getattr(self, item)
-
-
 @pytest.mark.django_db(transaction=False)
 class TestUpdateTransaction:
 
@@ -101,6 +83,45 @@ class TestUpdateTransaction:
 
         assert t.status == t.STATUS_REJECTED
 
+    def test_status_update_pending(self):
+        o = OrderFactory.create(state='pending')
+        t = TransactionFactory.create(order=o)
+
+        data = dict(Status=dict(Code=dict(Code=BUCKAROO_790_PENDING_INPUT)))
+
+        update_transaction(transaction=t, data=data)
+
+        assert t.status == t.STATUS_PENDING
+
+    def test_status_update_unknown_code(self):
+        o = OrderFactory.create(state='pending')
+        t = TransactionFactory.create(status='pending', order=o)
+
+        data = dict(Status=dict(Code=dict(Code=999)))
+
+        update_transaction(transaction=t, data=data)
+
+        assert t.status == t.STATUS_PENDING
+        assert t.last_push is not None
+
+
+class TestStatusMapping:
+
+    def test_map_status(self):
+        t = Transaction()
+
+        assert t.map_status(BUCKAROO_190_SUCCESS) == t.STATUS_SUCCESS
+        assert t.map_status(BUCKAROO_890_CANCELLED_BY_USER) == t.STATUS_CANCELLED
+        assert t.map_status(BUCKAROO_790_PENDING_INPUT) == t.STATUS_PENDING
+        assert t.map_status(BUCKAROO_690_REJECTED) == t.STATUS_REJECTED
+        assert t.map_status(BUCKAROO_490_FAILED) == t.STATUS_FAILED
+
+    def test_map_status_unknown(self):
+        t = Transaction()
+
+        assert t.map_status() is None
+        assert t.map_status(999) is None
+
 
 @pytest.fixture
 def simple_data(request):
@@ -421,3 +442,54 @@ class TestRedirectView:
         assert args['flag'] == 'failed'
         assert int(
             args['event']) == transaction_pending.order.tickets.first().event_id
+
+    def test_query_count(self, client, pending_order, buckaroo_settings):
+        """One query for transaction, order and event, one to save the transaction."""
+        transaction = TransactionFactory.create(status="success",
+                                                order=pending_order)
+        data = dict(BRQ_STATUSCODE=BUCKAROO_190_SUCCESS,
+                    BRQ_TRANSACTIONS=transaction.transaction_key)
+        dataenc = "".join("{}={}".format(k, v) for (k, v) in sorted(
+            data.items())) + buckaroo_settings.BUCKAROO_SECRET_KEY
+        data["BRQ_SIGNATURE"] = hashlib.sha1(dataenc.encode('utf8')).hexdigest()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(
+                reverse('guts_payment_return',
+                        kwargs={'pk': transaction.order.id}), data=data)
+
+        assert response.status_code == status.HTTP_302_FOUND
+        assert len(queries.captured_queries) == 2
+
+        args = dict(urllib.parse.parse_qsl(
+            response['location'].rsplit('/', 1)[-1]))
+        assert int(args['event']) == transaction.order.tickets.first().event_id
+
+    def test_query_count_transition(self, client, pending_order, buckaroo_settings):
+        """
+        Pending to success: one query for transaction, order and event, one
+        to save the order, one for the activity and one to save the
+        transaction.
+        """
+        transaction = TransactionFactory.create(status="pending",
+                                                order=pending_order)
+        data = dict(BRQ_STATUSCODE=BUCKAROO_190_SUCCESS,
+                    BRQ_TRANSACTIONS=transaction.transaction_key)
+        dataenc = "".join("{}={}".format(k, v) for (k, v) in sorted(
+            data.items())) + buckaroo_settings.BUCKAROO_SECRET_KEY
+        data["BRQ_SIGNATURE"] = hashlib.sha1(dataenc.encode('utf8')).hexdigest()
+
+        # The activity stream looks content types up once per process.
+        ContentType.objects.get_for_model(transaction)
+        ContentType.objects.get_for_model(transaction.order)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(
+                reverse('guts_payment_return',
+                        kwargs={'pk': transaction.order.id}), data=data)
+
+        assert response.status_code == status.HTTP_302_FOUND
+        assert len(queries.captured_queries) == 4, queries.captured_queries
+
+        transaction.refresh_from_db()
+        assert transaction.status == transaction.STATUS_SUCCESS
@@ -1,12 +1,21 @@
+import base64
+import hashlib
+import hmac
 import pytest
 import re
 
+from django.http import QueryDict
+
 from buckaroo.exceptions import BuckarooException
 from buckaroo.utils import (split_url, verify_buckaroo_signature,
                             get_redirect_url, get_transaction_key, get_payment_key,
-                            get_buckaroo_status_code, verify_transaction_fields)
+                            get_buckaroo_status_code, verify_transaction_fields,
+                            BuckarooResponse, get_base_transaction_json, add_ideal_json,
+                            add_creditcard_json, get_bank_codes)
 
-from buckaroo.auth import generate_nonce, generate_timestamp
+from buckaroo.auth import (generate_nonce, generate_timestamp, Signer, get_signer, AuthHeader,
+                           encode_json_body)
+from buckaroo.tests.server import get_signature, sign_return_data
 
 
 class TestUtils:
@@ -26,41 +35,41 @@ class TestUtils:
 
     def test_get_redirect_url(self):
         url = "www.test.com"
-        res = dict(RequiredAction=dict(RedirectURL=url))
+        res = BuckarooResponse(data=dict(RequiredAction=dict(RedirectURL=url)))
         result = get_redirect_url(res)
         assert result == url
 
     def test_get_redirect_exception(self):
-        res = dict()
+        res = BuckarooResponse(data=dict())
         with pytest.raises(BuckarooException) as err:
             get_redirect_url(res)
         assert err.value.args[0]['message'] == "No redirect url found"
 
     def test_get_transaction_key_success(self):
-        result = get_transaction_key(dict(Key="test"))
+        result = get_transaction_key(BuckarooResponse(data=dict(Key="test")))
         assert result == 'test'
 
     def test_get_transaction_key_exception(self):
         with pytest.raises(BuckarooException) as err:
-            get_transaction_key({})
+            get_transaction_key(BuckarooResponse())
         assert err.value.args[0]['message'] == "Transaction 'Key' not found"
 
     def test_get_payment_key_success(self):
-        result = get_payment_key(dict(PaymentKey="test"))
+        result = get_payment_key(BuckarooResponse(data=dict(PaymentKey="test")))
         assert result == 'test'
 
     def test_get_payment_key_exception(self):
         with pytest.raises(BuckarooException) as err:
-            get_payment_key({})
+            get_payment_key(BuckarooResponse())
         assert err.value.args[0]['message'] == "PaymentKey not found"
 
     def test_get_buckaroo_status_code(self):
-        res = dict(Status=dict(Code=dict(Code="test")))
+        res = BuckarooResponse(data=dict(Status=dict(Code=dict(Code="test"))))
         assert get_buckaroo_status_code(res) == 'test'
 
     def test_get_buckaroo_status_code_exception(self):
         with pytest.raises(BuckarooException) as err:
-            get_buckaroo_status_code({})
+            get_buckaroo_status_code(BuckarooResponse())
         assert err.value.args[0]['message'] == "Buckaroo status code not found"
 
     @pytest.mark.django_db(transaction=False)
@@ -106,6 +115,92 @@ class TestUtils:
         assert err.value.args[0]['field'] == "payment_method"
 
 
+class TestBuckarooResponse:
+    def test_decodes_once(self):
+        class HTTPResponse:
+            status_code = 200
+            decoded = 0
+
+            def json(self):
+                self.decoded += 1
+                return dict(PaymentKey='pk', Key='tk',
+                            Status=dict(Code=dict(Code=790)),
+                            RequiredAction=dict(RedirectURL='www.test.com'))
+
+        http_response = HTTPResponse()
+        res = BuckarooResponse.from_response(http_response)
+
+        assert res.status_code == 200
+        assert res.status == 790
+        assert res.payment_key == 'pk'
+        assert res.transaction_key == 'tk'
+        assert res.redirect_url == 'www.test.com'
+        assert http_response.decoded == 1
+
+    def test_invalid_json(self):
+        class HTTPResponse:
+            status_code = 500
+
+            def json(self):
+                raise ValueError("No JSON object could be decoded")
+
+        res = BuckarooResponse.from_response(HTTPResponse())
+
+        assert res.status_code == 500
+        assert res.data == {}
+
+
+@pytest.mark.django_db(transaction=False)
+class TestPayloadTemplates:
+    def test_ideal_service(self, settings, ideal_transaction):
+        settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+        body = add_ideal_json(get_base_transaction_json(ideal_transaction),
+                              ideal_transaction, 'pay')
+
+        assert body['Services']['ServiceList'] == [
+            {'Name': 'ideal', 'Version': 2, 'Action': 'Pay',
+             'Parameters': [{'Name': 'issuer', 'Value': 'ABNANL2A'}]}]
+
+    def test_creditcard_service(self, cc_transaction):
+        body = add_creditcard_json(get_base_transaction_json(cc_transaction),
+                                   cc_transaction, 'refund')
+
+        assert body['Services']['ServiceList'] == [
+            {'name': 'mastercard', 'Action': 'Refund',
+             'Parameters': [{'Name': 'RecurringInterval', 'Value': ''},
+                            {'Name': 'CustomerCode', 'Value': ''}]}]
+
+    def test_invalid_bank_code(self, settings, ideal_transaction):
+        settings.BANK_CODES = (('INGBNL2A', 'ING'),)
+        with pytest.raises(BuckarooException) as err:
+            add_ideal_json({}, ideal_transaction, 'pay')
+        assert err.value.args[0]['field'] == 'bank_code'
+
+    def test_missing_card(self, cc_transaction):
+        cc_transaction.card = None
+        with pytest.raises(BuckarooException) as err:
+            add_creditcard_json({}, cc_transaction, 'pay')
+        assert err.value.args[0]['field'] == 'card'
+
+    def test_service_list_not_shared(self, cc_transaction):
+        base = get_base_transaction_json(cc_transaction)
+
+        first = add_creditcard_json(base, cc_transaction, 'pay')
+        second = add_creditcard_json(base, cc_transaction, 'pay')
+
+        assert base['Services']['ServiceList'] == []
+        assert len(first['Services']['ServiceList']) == 1
+        assert first['Services']['ServiceList'][0] is not second['Services']['ServiceList'][0]
+
+    def test_bank_codes_follow_setting(self, settings):
+        settings.BANK_CODES = (('ABNANL2A', 'ABN AMRO'),)
+        assert get_bank_codes() == {'ABNANL2A'}
+        assert get_bank_codes() is get_bank_codes()
+
+        settings.BANK_CODES = (('RABONL2U', 'Rabobank'),)
+        assert get_bank_codes() == {'RABONL2U'}
+
+
 class TestNonce:
     def test_length(self):
         result = generate_nonce()
@@ -124,6 +219,63 @@ class TestNonce:
         assert re.match(pattern, result) is None
 
 
+class TestSigner:
+    def test_matches_plain_hmac(self):
+        msg = '12345' + 'POST' + 'uri' + '1500000000' + '00000001' + 'content'
+        expected = base64.b64encode(hmac.new(b'54321', msg.encode('utf-8'),
+                                             digestmod=hashlib.sha256).digest())
+
+        signer = Signer('12345', '54321')
+
+        assert signer.sign('POST', 'URI', 1500000000, '00000001', 'content') == expected
+        # The keyed state is copied, not consumed.
+        assert signer.sign('POST', 'URI', 1500000000, '00000001', 'content') == expected
+
+    def test_sign_many(self):
+        signer = Signer('12345', '54321')
+        messages = [('GET', 'uri/{0}'.format(i), 1500000000, '00000001', '') for i in range(3)]
+
+        assert signer.sign_many(messages) == [signer.sign(*m) for m in messages]
+
+    def test_auth_header(self):
+        header = Signer('12345', '54321').get_auth_header(
+            'https://testcheckout.buckaroo.nl/json/Transaction/', 'POST', {'Invoice': '1'},
+            nonce='00000001', request_timestamp=1500000000)
+
+        assert header.startswith('hmac 12345:')
+        assert header.endswith(':00000001:1500000000')
+
+    def test_get_signer_is_cached(self, settings):
+        settings.BUCKAROO_WEBSITE_KEY = '12345'
+        settings.BUCKAROO_SECRET_KEY = '54321'
+        assert get_signer() is get_signer()
+
+        settings.BUCKAROO_SECRET_KEY = 'other'
+        assert get_signer().sign('GET', 'uri', 1, '1') != \
+            Signer('12345', '54321').sign('GET', 'uri', 1, '1')
+
+
+class TestRequestBody:
+    def test_encoded_once(self):
+        data = {'Invoice': '1', 'AmountDebit': 10.0, 'Description': 'Tëst'}
+
+        assert AuthHeader(json=data).body == encode_json_body(data)
+        assert encode_json_body(data) == encode_json_body(dict(data))
+
+    def test_signature_covers_sent_body(self, settings):
+        settings.BUCKAROO_WEBSITE_KEY = '12345'
+        settings.BUCKAROO_SECRET_KEY = '54321'
+        body = encode_json_body({'Invoice': '1', 'AmountDebit': 10.0})
+
+        header = AuthHeader(url='https://testcheckout.buckaroo.nl/json/Transaction/',
+                            body=body).get_auth_header()
+        website_key, signature, nonce, timestamp = header[len('hmac '):].split(':')
+
+        assert signature == get_signature('12345', '54321', 'POST',
+                                          'testcheckout.buckaroo.nl/json/Transaction/',
+                                          nonce, timestamp, body)
+
+
 class TestTimestamp:
     def test_type(self):
         assert type(generate_timestamp()) is int
@@ -177,3 +329,19 @@ class TestSignatureUtils:
         full_data['BLA_Bla'] = '12345'
         full_data['BLA_Bla2'] = None
         assert verify_buckaroo_signature(full_data)
+
+    def test_valid_signature_percent_encoded(self, buckaroo_settings):
+        # Signed over the decoded value.
+        data = sign_return_data({'BRQ_CUSTOMER_NAME': 'J. de Tèster'},
+                                buckaroo_settings.BUCKAROO_SECRET_KEY)
+        data['BRQ_CUSTOMER_NAME'] = 'J.%20de%20T%C3%A8ster'
+        assert verify_buckaroo_signature(data)
+
+    def test_valid_signature_querydict(self, buckaroo_settings, full_data):
+        data = QueryDict(mutable=True)
+        data.update(full_data)
+        assert verify_buckaroo_signature(data)
+
+    def test_invalid_signature_type(self, buckaroo_settings, full_data):
+        full_data['BRQ_SIGNATURE'] = None
+        assert not verify_buckaroo_signature(full_data)
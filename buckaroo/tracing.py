@@ -0,0 +1,107 @@
+"""
+Tracing hooks for the payment hot paths.
+
+``span(name, transaction)`` opens a nested span named ``buckaroo.<name>``,
+tagged with the transaction uuid. By default spans are no-ops. The
+``BUCKAROO_TRACING`` setting enables them:
+
+* ``True`` uses the OpenTelemetry tracer provider (``opentelemetry-api``
+  must be installed, the ``tracing`` extra);
+* a dotted path names a tracer, or a callable returning one.
+
+Any object with an OpenTelemetry style
+``start_as_current_span(name, attributes=None)`` context manager works as
+a tracer, and ``set_tracer`` installs one directly.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # pragma: no cover
+    otel_trace = None
+
+
+logger = logging.getLogger(__name__)
+
+
+TRANSACTION_UUID = 'buckaroo.transaction.uuid'
+
+
+class NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class NoopTracer:
+    enabled = False
+
+    def start_as_current_span(self, name, attributes=None):
+        return NOOP_SPAN
+
+
+def load_tracer():
+    """The tracer configured with ``BUCKAROO_TRACING``."""
+    setting = getattr(settings, 'BUCKAROO_TRACING', False)
+
+    if not setting:
+        return NoopTracer()
+
+    if setting is True:
+        if otel_trace is None:
+            logger.warning("BUCKAROO_TRACING is on but opentelemetry is not installed")
+            return NoopTracer()
+        return otel_trace.get_tracer('buckaroo')
+
+    tracer = import_string(setting)
+    if not hasattr(tracer, 'start_as_current_span'):
+        tracer = tracer()
+    return tracer
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    global _tracer
+
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = load_tracer()
+    return _tracer
+
+
+def set_tracer(tracer=None):
+    """Install ``tracer``; None reloads it from the settings on next use."""
+    global _tracer
+
+    with _tracer_lock:
+        _tracer = tracer
+
+
+def span(name, transaction=None, **attributes):
+    """Context manager for a span around one step of ``transaction``."""
+    tracer = get_tracer()
+    if not getattr(tracer, 'enabled', True):
+        return NOOP_SPAN
+
+    uuid = getattr(transaction, 'uuid', None)
+    if uuid is not None:
+        attributes[TRANSACTION_UUID] = str(uuid)
+
+    return tracer.start_as_current_span('buckaroo.' + name, attributes=attributes)
@@ -5,6 +5,10 @@ urlpatterns = patterns(
     '',
     url(r'^transaction/$', views.TransactionList.as_view(),
         name='buckaroo_transaction_list'),
+    url(r'^transactions/$', views.TransactionDetail.as_view(),
+        name='buckaroo_transactions'),
     url(r'^push', views.PushView.as_view(),
-        name="buckaroo_push")
+        name="buckaroo_push"),
+    url(r'^metrics/$', views.MetricsView.as_view(),
+        name="buckaroo_metrics")
 )
@@ -1,25 +1,39 @@
 """Set of helpers for Buckaroo API."""
 
 import hashlib
+import hmac
 import urllib.parse
 import logging
-import requests
+import threading
+import time
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
 
 from django.conf import settings
+from django.db.models import Min
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
-from django_fsm import TransitionNotAllowed
 from .models import Transaction
 from .exceptions import BuckarooException
-from .auth import AuthHeader
-from .actions import (BUCKAROO_BASE_TEST_URL, BUCKAROO_BASE_PRODUCTION_URL,
-                      BUCKAROO_CHECKOUT_URL)
+from .auth import BuckarooAuth, encode_json_body
+from .client import get_client
+from .log import LogEvent, Payload
+from .metrics import record_status, status_codes
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
 
+BUCKAROO_BASE_TEST_URL = 'https://testcheckout.buckaroo.nl/'
+BUCKAROO_BASE_PRODUCTION_URL = 'https://checkout.buckaroo.nl/'
+
+BUCKAROO_CHECKOUT_URL = "json/Transaction/"
+BUCKAROO_REFUND_URL = 'json/Transaction/RefundInfo/'
+BUCKAROO_STATUS_URL = 'json/Transaction/Status/'
+
+
 def update_transaction_post(data=None):
     if not data:
         return
@@ -30,152 +44,231 @@ def update_transaction_post(data=None):
         logger.error("Transaction key not found in Buckaroo POST")
         return
 
+    # Load the order and the event id in the same query, the transitions
+    # and the return redirect both need them. For an order with tickets for
+    # several events this is the lowest event id, where the redirect used to
+    # take the event of the order's first ticket.
     try:
-        transaction = Transaction.objects.get(transaction_key=transaction_key)
+        transaction = (Transaction.objects.select_related('order')
+                       .annotate(order_event_id=Min('order__tickets__event'))
+                       .get(transaction_key=transaction_key))
     except Transaction.DoesNotExist:
-        logger.error("Transaction not found for payment key: {0}".format(transaction_key))
+        logger.error(LogEvent("Transaction not found", transaction_key=transaction_key))
         return
 
-    buckaroo_status = int(data.get('BRQ_STATUSCODE'))
+    with span('return', transaction, transaction_key=transaction_key):
+        buckaroo_status = int(data.get('BRQ_STATUSCODE'))
+        status_codes.inc(code=buckaroo_status, source='return')
 
-    transaction_status = transaction.map_status(status_code=buckaroo_status)
+        transaction.apply_status_code(buckaroo_status)
 
-    if transaction_status == transaction.STATUS_SUCCESS:
-        try:
-            transaction.success()
-        except TransitionNotAllowed as e:
-            logger.exception("Update of transaction to state success failed. {0}".format(e))
+        transaction.save()
 
-    if transaction_status == transaction.STATUS_CANCELLED:
-        try:
-            transaction.cancelled()
-        except TransitionNotAllowed as e:
-            logger.exception("Update of transaction to state cancelled failed. {0}".format(e))
+    return transaction
 
-    if transaction_status == transaction.STATUS_PENDING:
-        try:
-            transaction.pending()
-        except TransitionNotAllowed as e:
-            logger.exception(
-                "Update of transaction to state pending failed. {0}".format(e))
 
-    if transaction_status == transaction.STATUS_REJECTED:
-        try:
-            transaction.rejected()
-        except TransitionNotAllowed as e:
-            logger.exception(
-                "Update of transaction to state rejected failed. {0}".format(e))
+def update_transaction(transaction=None, data=None):
 
-    if transaction_status == transaction.STATUS_FAILED:
-        try:
-            transaction.failed()
-        except TransitionNotAllowed as e:
-            logger.exception(
-                "Update of transaction to state failed failed. {0}".format(e))
+    if not transaction or not data:
+        return None
+
+    try:
+        code = data['Status']['Code']['Code']
+    except KeyError:
+        logger.error(LogEvent("Status code not found", transaction=transaction.id,
+                              data=Payload(data)))
+        code = None
+
+    if code:
+        status_codes.inc(code=code, source='push')
+        transaction.apply_status_code(code)
+
+    transaction.last_push = timezone.now()
 
     transaction.save()
 
     return transaction
 
 
+SIGNED_FIELD_PREFIXES = ("BRQ_", "ADD_", "CUST_")
+
+
 def verify_buckaroo_signature(data):
+    """
+    Check the ``BRQ_SIGNATURE`` of a Buckaroo return or push POST: the SHA1
+    of the sorted ``key=value`` pairs of the signed fields plus the secret key.
+    """
     buckaroo_signature = data.get('BRQ_SIGNATURE', None)
     try:
         secret_key = settings.BUCKAROO_SECRET_KEY
     except AttributeError:
         raise BuckarooException("No Buckaroo secret key in settings")
 
-    urlencoded_signature = "".join(['{0}={1}'.format(k, v) for k, v in sorted(data.items())
-                                    if k is not None and (k.startswith("BRQ_") or
-                                    k.startswith("ADD_") or k.startswith("CUST_")) and
-                                    not k.startswith("BRQ_SIGNATURE")]) + secret_key
-    raw_signature = urllib.parse.unquote(urlencoded_signature)
-    signature = hashlib.sha1(raw_signature.encode('utf-8')).hexdigest()
+    if not isinstance(buckaroo_signature, str):
+        return False
 
-    if buckaroo_signature == signature:
-        return True
-    return False
+    fields = sorted((k, str(v)) for k, v in data.items()
+                    if k is not None and k.startswith(SIGNED_FIELD_PREFIXES) and
+                    not k.startswith("BRQ_SIGNATURE"))
+
+    if '%' in secret_key or any('%' in k or '%' in v for k, v in fields):
+        # Percent-escapes are decoded over the joined string, as Buckaroo does.
+        joined = "".join(['{0}={1}'.format(k, v) for k, v in fields]) + secret_key
+        signature = hashlib.sha1(urllib.parse.unquote(joined).encode('utf-8'))
+    else:
+        signature = hashlib.sha1()
+        for k, v in fields:
+            signature.update(k.encode('utf-8'))
+            signature.update(b'=')
+            signature.update(v.encode('utf-8'))
+        signature.update(secret_key.encode('utf-8'))
+
+    return hmac.compare_digest(signature.hexdigest().encode('utf-8'),
+                               buckaroo_signature.encode('utf-8'))
 
 
 def buckaroo_api_call(transaction, url, method, data=None):
 
-    auth_header = AuthHeader(transaction=transaction,
-                             url=url,
-                             json=data,
-                             method=method.upper()).get_auth_header()
+    # Encoded once: the same bytes are signed and sent.
+    body = encode_json_body(data) if data is not None else None
+    auth = BuckarooAuth(transaction=transaction, body=body)
 
-    headers = {'Authorization': auth_header, 'Content-Type': 'application/json'}
-    logger.info("API call for transaction: {0}, key {1}"
-                .format(transaction.id, transaction.transaction_key))
+    headers = {'Content-Type': 'application/json'}
+    logger.info(LogEvent("API call", transaction=transaction.id,
+                         transaction_key=transaction.transaction_key))
 
-    if method == 'POST':
-        res = requests.post(url, headers=headers, json=data)
-    if method == 'GET':
-        res = requests.get(url, headers=headers)
+    client = get_client()
 
-    logger.info("API response: {0}".format(res.json()))
+    with span('http', transaction, method=method, url=url):
+        if method == 'POST':
+            res = client.post(url, headers=headers, data=body, auth=auth)
+        if method == 'GET':
+            res = client.get(url, headers=headers, auth=auth)
 
-    return res
+    with span('parse', transaction):
+        response = BuckarooResponse.from_response(res)
+    record_status(response)
 
+    logger.info(LogEvent("API response", transaction=transaction.id,
+                         status_code=response.status_code, data=Payload(response.data)))
 
-def add_creditcard_json(body, transaction, action):
-    result = body.copy()
+    return response
 
-    card = transaction.card.lower()
 
-    if not card or card not in ['visa', 'mastercard']:
-            raise BuckarooException({"message": "Missing or erroneous field",
-                                     "field": "card"})
+class BuckarooResponse:
+    """
+    A Buckaroo API response. The JSON body is decoded once; the helpers
+    below read from ``data`` instead of decoding it again.
+    """
 
-    p1 = OrderedDict(Name='RecurringInterval',
-                     Value='')
+    def __init__(self, status_code=None, data=None):
+        self.status_code = status_code
+        self.data = data if data is not None else {}
 
-    p2 = OrderedDict(Name='CustomerCode',
-                     Value='')
+    @classmethod
+    def from_response(cls, response):
+        try:
+            data = response.json()
+        except ValueError:
+            logger.error("Buckaroo response is not valid JSON")
+            data = {}
+        return cls(status_code=response.status_code, data=data)
 
-    creditcard = OrderedDict(name=card,
-                             Parameters=[p1, p2])
+    @property
+    def status(self):
+        return get_buckaroo_status_code(self)
 
-    if action == 'pay':
-        creditcard.update(Action='Pay')
+    @property
+    def payment_key(self):
+        return get_payment_key(self)
 
-    if action == 'refund':
-        creditcard.update(Action='Refund')
+    @property
+    def transaction_key(self):
+        return get_transaction_key(self)
 
-    result['Services']['ServiceList'].append(creditcard)
+    @property
+    def redirect_url(self):
+        return get_redirect_url(self)
 
-    return result
 
+SERVICE_ACTIONS = MappingProxyType({'pay': 'Pay', 'refund': 'Refund'})
 
-def add_ideal_json(body, transaction, action):
+CREDITCARD_NAMES = frozenset(['visa', 'mastercard'])
+
+
+class ServiceTemplate(namedtuple('ServiceTemplate', 'fields parameters')):
+    """
+    Immutable Buckaroo ``ServiceList`` entry: ``fields`` and ``parameters``
+    are tuples of (name, default) pairs. ``fill`` builds fresh JSON for a
+    single request, so nothing is shared between payloads.
+    """
+
+    def fill(self, action, fields=None, parameters=None):
+        service = OrderedDict(self.fields)
+        if fields:
+            service.update(fields)
+
+        parameters = parameters or {}
+        service['Parameters'] = [OrderedDict((('Name', name),
+                                              ('Value', parameters.get(name, value))))
+                                 for name, value in self.parameters]
+
+        if action in SERVICE_ACTIONS:
+            service['Action'] = SERVICE_ACTIONS[action]
+
+        return service
 
-    result = body.copy()
 
-    bank_code = transaction.bank_code
-    bank_codes = [x[0] for x in settings.BANK_CODES]
+CREDITCARD_SERVICE = ServiceTemplate(fields=(('name', None),),
+                                     parameters=(('RecurringInterval', ''),
+                                                 ('CustomerCode', '')))
 
-    if not bank_code or bank_code not in bank_codes:
-        raise BuckarooException({"message": "Missing or erroneous field",
-                                 "field": "bank_code"})
+IDEAL_SERVICE = ServiceTemplate(fields=(('Name', 'ideal'), ('Version', 2)),
+                                parameters=(('issuer', None),))
 
-    p1 = OrderedDict(Name='issuer',
-                     Value=bank_code)
 
-    ideal = OrderedDict(Name='ideal',
-                        Version=2,
-                        Parameters=[p1])
+_bank_codes = (None, frozenset())
 
-    if action == 'pay':
-        ideal.update(Action='Pay')
 
-    if action == 'refund':
-        ideal.update(Action='Refund')
+def get_bank_codes():
+    """The codes in ``settings.BANK_CODES``, rebuilt only when the setting is replaced."""
+    global _bank_codes
 
-    result['Services']['ServiceList'].append(ideal)
+    choices = settings.BANK_CODES
+    if _bank_codes[0] is not choices:
+        _bank_codes = (choices, frozenset(x[0] for x in choices))
+    return _bank_codes[1]
 
+
+def add_service_json(body, service):
+    """Copy of ``body`` with ``service`` appended to a new ``ServiceList``."""
+    result = body.copy()
+    services = result.get('Services') or {}
+    result['Services'] = OrderedDict(services)
+    result['Services']['ServiceList'] = list(services.get('ServiceList', ())) + [service]
     return result
 
 
+def add_creditcard_json(body, transaction, action):
+    from .methods import Creditcard
+
+    Creditcard().validate(transaction)
+    card = transaction.card.lower()
+
+    creditcard = CREDITCARD_SERVICE.fill(action, fields={'name': card})
+
+    return add_service_json(body, creditcard)
+
+
+def add_ideal_json(body, transaction, action):
+    from .methods import Ideal
+
+    Ideal().validate(transaction)
+    ideal = IDEAL_SERVICE.fill(action, parameters={'issuer': transaction.bank_code})
+
+    return add_service_json(body, ideal)
+
+
 def add_refund_json(body, transaction, amount):
     result = body.copy()
     result.update(AmountCredit=float(amount),
@@ -206,42 +299,42 @@ def get_base_transaction_json(transaction):
     return body
 
 
-def get_buckaroo_status_code(response={}):
+def get_buckaroo_status_code(response=None):
     """Get the status from the Buckaroo transaction."""
     try:
-        return response['Status']['Code']['Code']
-    except KeyError:
+        return response.data['Status']['Code']['Code']
+    except (KeyError, TypeError):
         raise BuckarooException({"message": "Buckaroo status code not found"})
 
 
-def get_payment_key(response={}):
+def get_payment_key(response=None):
     # Save payment identifier
     try:
-        return response['PaymentKey']
-    except KeyError:
+        return response.data['PaymentKey']
+    except (KeyError, TypeError):
         raise BuckarooException({'message': "PaymentKey not found"})
 
 
-def get_transaction_key(response={}):
+def get_transaction_key(response=None):
     # Save transaction key identifier
     try:
-        return response['Key']
-    except KeyError:
+        return response.data['Key']
+    except (KeyError, TypeError):
         raise BuckarooException({'message': "Transaction 'Key' not found"})
 
 
-def get_key(response={}, key_name=None):
+def get_key(response=None, key_name=None):
     try:
-        return response[key_name]
-    except KeyError:
+        return response.data[key_name]
+    except (KeyError, TypeError):
         raise BuckarooException({'message': "{0} not found".format(key_name)})
 
 
-def get_redirect_url(response={}):
+def get_redirect_url(response=None):
     """Parse the response for the redirct url."""
     try:
-        return response['RequiredAction']['RedirectURL']
-    except KeyError:
+        return response.data['RequiredAction']['RedirectURL']
+    except (KeyError, TypeError):
         raise BuckarooException({"message": "No redirect url found"})
 
 
@@ -250,7 +343,10 @@ def verify_transaction_fields(transaction):
         raise BuckarooException({"message": "Required field missing",
                                  "field": "payment_method"})
 
-    if transaction.payment_method not in ['creditcard', 'ideal']:
+    from .methods import get_payment_method
+
+    method = get_payment_method(transaction.payment_method)
+    if method is None:
         raise BuckarooException({"message": "Unknown payment method",
                                  "field": "payment_method"})
 
@@ -262,14 +358,49 @@ def verify_transaction_fields(transaction):
         raise BuckarooException({"message": "Required field missing",
                                  "field": "order.total"})
 
+    method.validate(transaction)
+
+
+def get_base_url(testing=None):
+    """
+    Buckaroo base url. ``BUCKAROO_BASE_URL`` overrides it, e.g. to point at
+    the stand-in server in ``buckaroo.tests.server``.
+    """
+    base_url = getattr(settings, 'BUCKAROO_BASE_URL', None)
+    if base_url:
+        return base_url
+
+    if testing is None:
+        testing = settings.BUCKAROO_TEST_MODE
+
+    if testing:
+        return BUCKAROO_BASE_TEST_URL
+    return BUCKAROO_BASE_PRODUCTION_URL
+
 
 def construct_url():
-    if settings.BUCKAROO_TEST_MODE:
-        return ''.join([BUCKAROO_BASE_TEST_URL,
-                        BUCKAROO_CHECKOUT_URL])
-    else:
-        return''.join([BUCKAROO_BASE_PRODUCTION_URL,
-                       BUCKAROO_CHECKOUT_URL])
+    return ''.join([get_base_url(), BUCKAROO_CHECKOUT_URL])
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls to at most ``rate`` per second."""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
 
 
 def split_url(url):
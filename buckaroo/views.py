@@ -1,35 +1,121 @@
-import django_fsm
+import hashlib
 import logging
 import urllib.parse
 
-from django.utils import timezone
+from datetime import datetime, time, timedelta
+
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from rest_framework import generics
+from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAuthenticated
+
+from order.models import Order
 
 from .models import Transaction
 from .serializers import TransactionSerializer
 from .actions import Pay
-from .exceptions import BuckarooException, BuckarooAPIException
-from .utils import verify_buckaroo_signature, update_transaction_post
+from .exceptions import BuckarooException, BuckarooAPIException, PaymentInProgress
+from .log import LogEvent, Payload
+from .utils import (verify_buckaroo_signature, update_transaction_post,
+                    update_transaction)  # noqa
+from .tasks import process_push
+from .dedup import get_push_key, push_deduplicator
+from .metrics import REGISTRY, CONTENT_TYPE, signature_failures
+from .tracing import span
 
-from .permissions import PostOnly, BuckarooServer
+from .permissions import PostOnly, BuckarooServer, MetricsAccess
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_IDEMPOTENCY_WINDOW = 300
+
+
 class TransactionList(generics.ListCreateAPIView):
-    """List view for Transaction."""
+    """
+    List view for Transaction.
+
+    Creating a transaction is idempotent for ``BUCKAROO_IDEMPOTENCY_WINDOW``
+    seconds: a repeated request for the same order (and the same
+    ``Idempotency-Key`` header or payment details) gets the pending
+    transaction of the first request back instead of starting a new payment.
+    """
 
     permission_classes = (PostOnly,)
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
 
+    def get_idempotency_window(self):
+        return getattr(settings, 'BUCKAROO_IDEMPOTENCY_WINDOW', DEFAULT_IDEMPOTENCY_WINDOW)
+
+    def get_idempotency_key(self, data):
+        key = self.request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key:
+            key = ':'.join(str(data.get(field)) for field in ('payment_method',
+                                                              'bank_code', 'card'))
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return 'buckaroo:pay:{0}:{1}'.format(data['order'].id, digest)
+
+    def get_replayed_transaction(self, data):
+        """The pending transaction of an earlier identical request, if any."""
+        order = data['order']
+        if order.owner != self.request.user:
+            return None
+
+        queryset = Transaction.objects.filter(order=order,
+                                              status=Transaction.STATUS_PENDING,
+                                              redirect_url__isnull=False)
+
+        transaction_id = cache.get(self.get_idempotency_key(data))
+        if transaction_id is not None:
+            return queryset.filter(pk=transaction_id).first()
+
+        if self.request.META.get('HTTP_IDEMPOTENCY_KEY'):
+            return None
+
+        since = timezone.now() - timedelta(seconds=self.get_idempotency_window())
+        return (queryset.filter(payment_method=data.get('payment_method'),
+                                bank_code=data.get('bank_code'),
+                                card=data.get('card'),
+                                created__gte=since)
+                .order_by('-created').first())
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        existing = self.get_replayed_transaction(serializer.validated_data)
+        if existing is not None:
+            logger.info(LogEvent("Returning pending transaction for repeated payment request",
+                                 transaction=existing.id))
+            return Response(self.get_serializer(existing).data, status=status.HTTP_200_OK)
+
+        key = self.get_idempotency_key(serializer.validated_data)
+
+        # Concurrent duplicates (double clicks) wait for the first request.
+        lock_key = key + ':lock'
+        if not cache.add(lock_key, True, 60):
+            raise PaymentInProgress()
+
+        try:
+            self.perform_create(serializer)
+            # Before the lock goes, or a duplicate could slip in between.
+            cache.set(key, serializer.instance.id, self.get_idempotency_window())
+        finally:
+            cache.delete(lock_key)
+
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
     def perform_create(self, serializer):
         instance = serializer.save(status='new')
 
@@ -41,55 +127,117 @@ class TransactionList(generics.ListCreateAPIView):
                                   .format(instance.order.state))
 
         try:
-            logger.info("Starting Buckaroo Paymnent for transaction {0}".format(instance.id))
+            logger.info(LogEvent("Starting Buckaroo payment", transaction=instance.id))
             Pay(transaction=instance, testing=settings.TESTING).pay()
         except BuckarooException as err:
-            logger.exception("Service exception: {0}".format(err))
+            logger.exception(LogEvent("Service exception", error=err))
             raise BuckarooAPIException(detail=err)
 
 
-class TransactionDetail(generics.ListCreateAPIView):
-    """Detail view for Transaction."""
+class TransactionCursorPagination(CursorPagination):
+    """Newest first; the cursor stays fast however deep the client pages."""
+
+    ordering = ('-created', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    _page_size = None
+
+    @property
+    def page_size(self):
+        # Read on use, not at import, so the setting can change (and be overridden in tests).
+        if self._page_size is None:
+            return getattr(settings, 'BUCKAROO_TRANSACTION_PAGE_SIZE', 50)
+        return self._page_size
+
+    @page_size.setter
+    def page_size(self, value):
+        # DRF stores the page size of the current request here.
+        self._page_size = value
 
-    queryset = Transaction.objects.all()
-    serializer_class = TransactionSerializer
 
+class TransactionDetail(generics.ListAPIView):
+    """
+    Transactions of the orders of the current user.
+
+    Cursor paginated, newest first. Filters: ``status``, ``payment_method``,
+    ``order`` and the ``created_after``/``created_before`` range (ISO date
+    or datetime). Pages carry an ``ETag``; a matching ``If-None-Match``
+    gets a 304 without the page being serialized.
+    """
+
+    permission_classes = (IsAuthenticated,)
+    serializer_class = TransactionSerializer
+    pagination_class = TransactionCursorPagination
 
-def update_transaction(transaction=None, data=None):
+    filter_params = ('status', 'payment_method', 'order')
 
-    if not transaction or not data:
-        return None
+    def get_queryset(self):
+        # Filter on the user's order ids, without a join, so the
+        # (order, created, id) index serves the listing. Only the serializer
+        # fields, plus the cursor and ETag fields.
+        orders = Order.objects.filter(owner=self.request.user).values('id')
+        return (Transaction.objects.filter(order_id__in=orders)
+                .only('id', 'payment_method', 'order', 'status', 'uuid', 'redirect_url',
+                      'card', 'bank_code', 'created', 'modified'))
 
-    try:
-        code = data['Status']['Code']['Code']
-    except KeyError:
-        logger.error("Status code not found. Data: {0}".format(data))
-        if transaction:
-            logger.error("Transaction id: {0}".format(transaction.id))
-        code = None
+    def parse_date_param(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
 
-    if code:
-        status = transaction.map_status(status_code=code)
-        logger.info("Updating transaction {0} status to {1}".format(transaction.id, status))
         try:
-            if status == transaction.STATUS_SUCCESS:
-                transaction.success()
-            elif status == transaction.STATUS_CANCELLED:
-                transaction.cancelled()
-            elif status == transaction.STATUS_FAILED:
-                transaction.failed()
-            elif status == transaction.STATUS_REJECTED:
-                transaction.rejected()
-            else:
-                logger.error("Status not found: {0}".format(transaction.status))
-        except django_fsm.TransitionNotAllowed as e:
-            logger.error("Failed to change transaction status: {0}".format(e))
+            parsed = parse_datetime(value)
+            if parsed is None:
+                date = parse_date(value)
+                parsed = datetime.combine(date, time.min) if date else None
+        except ValueError:
+            parsed = None
+
+        if parsed is None:
+            raise ValidationError({name: "Not an ISO date or datetime: {0}".format(value)})
+
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+
+        filters = {field: params[field] for field in self.filter_params if params.get(field)}
+        if 'order' in filters and not filters['order'].isdigit():
+            raise ValidationError({'order': "Not an order id: {0}".format(filters['order'])})
+
+        created_after = self.parse_date_param('created_after')
+        if created_after:
+            filters['created__gte'] = created_after
 
-    transaction.last_push = timezone.now()
+        created_before = self.parse_date_param('created_before')
+        if created_before:
+            filters['created__lt'] = created_before
 
-    transaction.save()
+        return super().filter_queryset(queryset).filter(**filters)
 
-    return transaction
+    def get_etag(self, page):
+        digest = hashlib.md5(self.request.get_full_path().encode('utf-8'))
+        for transaction in page:
+            digest.update('{0}:{1};'.format(transaction.pk,
+                                            transaction.modified.isoformat()).encode('utf-8'))
+        digest.update(str(self.paginator.get_next_link()).encode('utf-8'))
+        digest.update(str(self.paginator.get_previous_link()).encode('utf-8'))
+        return '"{0}"'.format(digest.hexdigest())
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        etag = self.get_etag(page)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match == '*':
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response['ETag'] = etag
+        return response
 
 
 class PushView(APIView):
@@ -100,20 +248,39 @@ class PushView(APIView):
 
         t_data = request.data.get('Transaction', None)
 
-        logger.info("Received Buckaroo API push. Data: {0}".format(t_data))
+        logger.info(LogEvent("Received Buckaroo API push", data=Payload(t_data)))
 
         if t_data:
             try:
-                transaction = Transaction.objects.get(payment_key=t_data['PaymentKey'])
-            except (Transaction.DoesNotExist, TypeError):
+                t_data['PaymentKey']
+            except (KeyError, TypeError):
                 logger.warning("Transaction not found")
                 return Response("Transaction not found")
 
-            update_transaction(transaction=transaction, data=t_data)
+            push_key = get_push_key(t_data)
+            if push_key and push_deduplicator.is_duplicate(push_key):
+                logger.info(LogEvent("Ignoring repeated Buckaroo push", key=push_key))
+                return Response("ok")
+
+            # Acknowledge right away, a huey worker applies the update.
+            try:
+                process_push(t_data)
+            except Exception:
+                if push_key:
+                    push_deduplicator.forget(push_key)
+                raise
 
         return Response("ok")
 
 
+class MetricsView(APIView):
+    """Buckaroo metrics in the Prometheus text format."""
+    permission_classes = (MetricsAccess,)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(REGISTRY.generate_text(), content_type=CONTENT_TYPE)
+
+
 def PaymentReturnRedirectView(request, pk, *args, **kwargs):
     """
         Buckaroo does a POST request to our server with payment information. Ember cannot
@@ -129,11 +296,17 @@ def PaymentReturnRedirectView(request, pk, *args, **kwargs):
 
     data = request.POST
 
-    if verify_buckaroo_signature(data):
+    # The transaction is only loaded once the signature is valid, the
+    # 'return' span in update_transaction_post carries its uuid.
+    with span('verify_signature', transaction_key=data.get('BRQ_TRANSACTIONS', '')):
+        valid = verify_buckaroo_signature(data)
+
+    if valid:
         transaction = update_transaction_post(data)
     else:
-        logger.warning(
-            "Received POST request with invalid signature. Data: {0}".format(data))
+        signature_failures.inc()
+        logger.warning(LogEvent("Received POST request with invalid signature",
+                                data=Payload(data)))
         return HttpResponse("Invalid signature", status=500)
 
     # Add flag to indicate whether there was success,
@@ -150,7 +323,7 @@ def PaymentReturnRedirectView(request, pk, *args, **kwargs):
     data['flag'] = flag
 
     # let the frontend also know for which event it was
-    data['event'] = transaction.order.tickets.first().event_id
+    data['event'] = transaction.order_event_id
 
     response['Location'] = ("{0}/orders/"
                             "paymentReturn/{1}/{2}").format(settings.EMBER_URL,
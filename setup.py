@@ -12,6 +12,11 @@ setup(
     version='0.1',
     packages=find_packages(),
     include_package_data=True,
+    extras_require={
+        # aiohttp.ClientTimeout needs aiohttp 3.3, which needs Python 3.5.3 or later.
+        'async': ['aiohttp>=3.3'],
+        'tracing': ['opentelemetry-api'],
+    },
     license='BSD License',  # example license
     description='A Django application for the Buckaroo API',
     long_description=README,